@@ -0,0 +1,255 @@
+"""Benchmarks of main.py against the fake gnucash backend
+
+Generates synthetic books and TSV files and times the lookups and import
+loops of CashScript for every book size.
+
+Usage:
+  benchmark.py [options]
+
+Options:
+  -h --help             Show this screen.
+  --splits <sizes>      Comma separated number of splits in the checking account [default: 10000,100000].
+  --depth <n>           Depth of the investment account tree [default: 4].
+  --stocks <n>          Number of stock accounts [default: 200].
+  --prices <n>          Number of historical prices per stock [default: 1000].
+  --lines <n>           Number of lines of the synthetic statement and portfolio files [default: 2000].
+  --lookups <n>         Number of lookups timed for the single operations [default: 2000].
+  --seed <n>            Seed of the random generator [default: 1].
+  --json <file>         Write the results as JSON.
+
+"""
+
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+sys.path.insert(0, bench_dir)
+
+from docopt import docopt
+
+import gnucash
+from gnucash import Account, Session, Transaction, Split, GncNumeric, GncCommodity, GncPrice, ACCT_TYPE_STOCK
+
+import main
+import report
+
+
+start_date = datetime(2000, 1, 1)
+splits_per_day = 20
+giro_number = "12345"
+
+
+def isin(i):
+    return "XX" + "{:010d}".format(i)
+
+
+class SyntheticBook:
+    """A book with a checking account, an investment tree and price histories"""
+
+    def __init__(self, splits, depth, stocks, prices, rnd):
+        self.session = Session(None)
+        self.book = self.session.book
+        self.rnd = rnd
+        self.eur = self.book.get_table().lookup("CURRENCY", "EUR")
+        root = self.book.get_root_account()
+
+        assets = self.account(root, "Assets")
+        current = self.account(assets, "Current Assets")
+        self.checking = self.account(current, "Checking Account")
+        self.giro = self.account(self.checking, "Giro", "Konto " + giro_number)
+        self.invest = self.account(assets, "Investments")
+        expenses = self.account(root, "Expenses")
+        self.account(self.account(expenses, "Services"), "Broker")
+        trading = self.account(root, "Trading")
+        self.account(self.account(trading, "CURRENCY"), "EUR")
+
+        self.stocks = []
+        for i in range(stocks):
+            parent = self.invest
+            for level in range(depth - 1):
+                parent = self.lookup_or_account(parent, "Level" + str(level) + "-" + str(i % (level + 2)))
+            commodity = GncCommodity(self.book, "Stock " + str(i), "Stock", isin(i), isin(i), 1000000)
+            commodity = self.book.get_table().insert(commodity)
+            stock_acc = self.account(parent, isin(i) + " Stock " + str(i), commodity=commodity)
+            stock_acc.SetType(ACCT_TYPE_STOCK)
+            self.stocks.append(stock_acc)
+
+        self.transactions = []
+        for i in range(splits):
+            date = start_date + timedelta(days=i // splits_per_day)
+            stock = i % max(stocks, 1)
+            self.transactions.append((date, "Kauf " + isin(stock), str(i), -rnd.randrange(100, 1000000)))
+            self.transaction(*self.transactions[-1])
+
+        price_db = self.book.get_price_db()
+        for stock_acc in self.stocks:
+            for day in range(prices):
+                price = GncPrice(self.book)
+                price.set_commodity(stock_acc.GetCommodity())
+                price.set_currency(self.eur)
+                price.set_time64(start_date + timedelta(days=day))
+                price.set_value(GncNumeric(rnd.randrange(100, 100000), 100))
+                price_db.add_price(price)
+
+    def account(self, parent, name, description="", commodity=None):
+        acc = Account(self.book)
+        acc.SetName(name)
+        acc.SetDescription(description)
+        acc.SetCommodity(commodity or self.eur)
+        parent.append_child(acc)
+        return acc
+
+    def lookup_or_account(self, parent, name):
+        for child in parent.get_children():
+            if child.GetName() == name:
+                return child
+        return self.account(parent, name)
+
+    def transaction(self, date, description, num, cents):
+        tx = Transaction(self.book)
+        tx.BeginEdit()
+        tx.SetCurrency(self.eur)
+        tx.SetDate(date.day, date.month, date.year)
+        tx.SetDescription(description)
+        tx.SetNum(num)
+        split = Split(self.book)
+        split.SetParent(tx)
+        split.SetAccount(self.giro)
+        split.SetValue(GncNumeric(cents, 100))
+        split.SetAmount(GncNumeric(cents, 100))
+        tx.CommitEdit()
+
+
+def write_statement(path, book, lines, rnd):
+    """Half of the lines match existing transactions, the other half are new"""
+    with open(path, "w") as f:
+        f.write("# synthetic statement\n")
+        for i in range(lines):
+            if i % 2 == 0 and book.transactions:
+                date, description, num, cents = rnd.choice(book.transactions)
+            else:
+                date = start_date + timedelta(days=rnd.randrange(len(book.transactions) // splits_per_day + 1))
+                description, num, cents = "Lastschrift " + str(i), "n" + str(i), rnd.randrange(-100000, 100000)
+            row = [date.date().isoformat(), "", "", "", description, num, "EUR", str(cents)]
+            f.write("\t".join(row) + "\n")
+
+
+def write_portfolio(path, book, lines, rnd):
+    """Every line buys the stock of a distinct existing transaction, valuta a few days after the entry date"""
+    with open(path, "w") as f:
+        f.write("# synthetic portfolio\n")
+        for date, description, num, cents in rnd.sample(book.transactions, min(lines, len(book.transactions))):
+            stock_isin = description.split(" ")[1]
+            entry = date - timedelta(days=rnd.randrange(3))
+            price = rnd.randrange(100, 10000)
+            count = max(1, (-cents - 500) // price)
+            row = [giro_number, entry.date().isoformat(), date.date().isoformat(), stock_isin, "Stock",
+                   str(count), "St", "Kauf Auftrag " + num, "", "{},{:02d}".format(price // 100, price % 100), "Depot"]
+            f.write("\t".join(row) + "\n")
+
+
+def cash_script(book, heuristic=False, jobs=1):
+    args = {"--heuristic": heuristic, "--heuristic-days": "2", "--stock-description": None, "--jobs": str(jobs)}
+    return main.CashScript(book.session, args)
+
+
+def timed(results, name, size, count, function):
+    calls = gnucash.calls
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        function()
+    seconds = time.perf_counter() - start
+    result = {
+        "benchmark": name, "splits": size, "count": count, "seconds": seconds,
+        "per_op_us": seconds / max(count, 1) * 1e6, "calls": gnucash.calls - calls,
+        }
+    results.append(result)
+    print("{:<28}{:>10}{:>10}{:>12.3f}{:>14.1f}{:>14}".format(
+        name, size, count, seconds, result["per_op_us"], result["calls"]))
+    return result
+
+
+def run(size, args, rnd, results, tmp_dir):
+    lookups = int(args["--lookups"])
+    lines = int(args["--lines"])
+
+    start = time.perf_counter()
+    book = SyntheticBook(size, int(args["--depth"]), int(args["--stocks"]), int(args["--prices"]), rnd)
+    print("{:<28}{:>10}{:>10}{:>12.3f}".format("generate book", size, size, time.perf_counter() - start))
+
+    cs = cash_script(book)
+    samples = [rnd.choice(book.transactions) for _ in range(lookups)]
+
+    timed(results, "split index build", size, size, lambda: cs.split_index.load(book.giro))
+
+    def find_transactions():
+        for date, description, num, cents in samples:
+            cs.find_transaction(book.giro, date, description, {"num": num, "value": GncNumeric(cents, 100)})
+    timed(results, "find_transaction", size, lookups, find_transactions)
+
+    def find_ranges():
+        for date, description, num, cents in samples:
+            cs.find_transactions_in_range(book.giro, date - timedelta(days=3), date, description.split(" ")[1],
+                                          check_desc=main.CheckDescription.substr)
+    timed(results, "find_transactions_in_range", size, lookups, find_ranges)
+
+    isins = [isin(rnd.randrange(len(book.stocks))) for _ in range(lookups)] if book.stocks else []
+    def find_isins():
+        for stock_isin in isins:
+            cs.find_account_by_isin(book.invest, stock_isin)
+    timed(results, "find_account_by_isin", size, len(isins), find_isins)
+
+    quotes = []
+    for _ in range(lookups if book.stocks else 0):
+        stock_acc = rnd.choice(book.stocks)
+        date = start_date + timedelta(days=rnd.randrange(2 * int(args["--prices"]) + 1))
+        quotes.append((stock_acc.GetCommodity(), rnd.randrange(100, 100000), date))
+    def stock_prices():
+        for commodity, cents, date in quotes:
+            cs.goc_stock_price(commodity, cents, date)
+    timed(results, "goc_stock_price", size, len(quotes), stock_prices)
+
+    statement = os.path.join(tmp_dir, "statement-" + str(size) + ".tsv")
+    write_statement(statement, book, lines, rnd)
+    timed(results, "statement import", size, lines,
+          lambda: cs.read_statement_transactions(statement, book.giro))
+    heuristic = cash_script(book, heuristic=True)
+    timed(results, "statement import heuristic", size, lines,
+          lambda: heuristic.read_statement_transactions(statement, book.giro))
+
+    portfolio = os.path.join(tmp_dir, "portfolio-" + str(size) + ".tsv")
+    write_portfolio(portfolio, book, lines, rnd)
+    timed(results, "portfolio import", size, lines,
+          lambda: cs.read_portfolio_transactions(portfolio, book.checking, book.invest))
+    partitioned = cash_script(book, jobs=2)
+    timed(results, "portfolio import jobs=2", size, lines,
+          lambda: partitioned.read_portfolio_transactions(portfolio, book.checking, book.invest))
+
+    export = os.path.join(tmp_dir, "export-" + str(size) + ".npz")
+    timed(results, "export", size, size,
+          lambda: report.export(export, book.book.get_root_account(), cs.commod_tab, cs.price_db, cs.split_fmt, cs.log))
+    tables = report.load(export)
+    for name, function in report.reports.items():
+        timed(results, "report " + name, size, size, lambda: function(tables, cs.log))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    rnd = random.Random(int(args["--seed"]))
+    results = []
+
+    print("{:<28}{:>10}{:>10}{:>12}{:>14}{:>14}".format("benchmark", "splits", "count", "seconds", "us/op", "calls"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args["--splits"].split(","):
+            run(int(size), args, rnd, results, tmp_dir)
+
+    if args["--json"]:
+        with open(args["--json"], "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,612 @@
+"""Pure-Python stand-in for the parts of the gnucash bindings used by main.py.
+
+Only the surface touched by the scripts is implemented: accounts, splits,
+transactions, GncNumeric, GncPrice, the commodity table and the price
+database. Lookups that fail return None like the SWIG wrappers do, and
+every call that would cross into C is counted in `calls`.
+
+Put the bench directory in front of the python path to use it, e.g.
+PYTHONPATH=bench python3 main.py ... Books are stored as pickle files.
+"""
+
+import itertools
+import os
+import pickle
+import uuid
+from datetime import datetime
+
+ACCT_TYPE_BANK = 0
+ACCT_TYPE_CASH = 1
+ACCT_TYPE_ASSET = 2
+ACCT_TYPE_STOCK = 5
+ACCT_TYPE_MUTUAL = 6
+ACCT_TYPE_CURRENCY = 7
+ACCT_TYPE_INCOME = 8
+ACCT_TYPE_EXPENSE = 9
+ACCT_TYPE_EQUITY = 10
+ACCT_TYPE_TRADING = 14
+
+# number of calls into the "bindings", comparable to SWIG round trips
+calls = 0
+# number of transaction edits that were committed, each one is a write of a SQL backend
+commits = 0
+
+
+def _count():
+    global calls
+    calls += 1
+
+
+class GUID:
+    def __init__(self, value=None):
+        self.value = value or uuid.uuid4().hex
+
+    def get_instance(self):
+        return self
+
+    def to_string(self):
+        return self.value
+
+    def __eq__(self, other):
+        return isinstance(other, GUID) and self.value == other.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def TransLookup(self, book):
+        return book._transactions.get(self.value)
+
+    def AccountLookup(self, book):
+        return book._accounts.get(self.value)
+
+
+class GncNumeric:
+    def __init__(self, num=0, denom=1):
+        if isinstance(num, GncNumeric):
+            num, denom = num._num, num._denom
+        self._num = int(num)
+        self._denom = int(denom)
+
+    def num(self):
+        _count()
+        return self._num
+
+    def denom(self):
+        _count()
+        return self._denom
+
+    def to_double(self):
+        return self._num / self._denom
+
+    def __str__(self):
+        return str(self._num) + "/" + str(self._denom)
+
+    __repr__ = __str__
+
+
+class GncCommodity:
+    def __init__(self, book, fullname, namespace, mnemonic, cusip, fraction):
+        self._book = book
+        self._fullname = fullname
+        self._namespace = namespace
+        self._mnemonic = mnemonic
+        self._cusip = cusip
+        self._fraction = fraction
+
+    def get_fullname(self):
+        _count()
+        return self._fullname
+
+    def get_mnemonic(self):
+        _count()
+        return self._mnemonic
+
+    def get_namespace(self):
+        _count()
+        return self._namespace
+
+    def get_namespace_ds(self):
+        return self._namespace
+
+    def get_default_symbol(self):
+        return self._mnemonic
+
+    def get_user_symbol(self):
+        return self._mnemonic
+
+    def get_cusip(self):
+        _count()
+        return self._cusip
+
+    def get_fraction(self):
+        _count()
+        return self._fraction
+
+    def get_unique_name(self):
+        _count()
+        return self._namespace + "::" + self._mnemonic
+
+    def get_quote_flag(self):
+        return False
+
+    def get_quote_source(self):
+        return None
+
+    def get_quote_tz(self):
+        return None
+
+
+class GncCommodityTable:
+    def __init__(self, book):
+        self._book = book
+        self._commodities = {}
+
+    def lookup(self, namespace, mnemonic):
+        _count()
+        if namespace == "ISO4217":
+            namespace = "CURRENCY"
+        return self._commodities.get((namespace, mnemonic))
+
+    def insert(self, commodity):
+        _count()
+        key = (commodity._namespace, commodity._mnemonic)
+        return self._commodities.setdefault(key, commodity)
+
+    def get_namespaces(self):
+        return sorted(set(ns for ns, _ in self._commodities))
+
+    def get_commodities(self, namespace):
+        return [c for (ns, _), c in self._commodities.items() if ns == namespace]
+
+
+class GncPrice:
+    def __init__(self, book):
+        self._book = book
+        self._commodity = None
+        self._currency = None
+        self._time = None
+        self._value = GncNumeric(0, 1)
+
+    def set_commodity(self, commodity):
+        self._commodity = commodity
+
+    def get_commodity(self):
+        return self._commodity
+
+    def set_currency(self, currency):
+        self._currency = currency
+
+    def get_currency(self):
+        return self._currency
+
+    def set_time64(self, time):
+        self._time = time
+
+    def get_time64(self):
+        _count()
+        return self._time
+
+    def set_value(self, value):
+        self._value = value
+
+    def get_value(self):
+        _count()
+        return GncNumeric(self._value)
+
+
+class GncPriceDB:
+    def __init__(self, book):
+        self._book = book
+        self._prices = {}
+        self.edit_level = 0
+
+    def _key(self, commodity, currency):
+        return (commodity.get_unique_name(), currency.get_unique_name())
+
+    def get_prices(self, commodity, currency):
+        _count()
+        if currency is None:
+            return [p for (c, _), prices in self._prices.items()
+                    if c == commodity.get_unique_name() for p in prices]
+        return list(self._prices.get(self._key(commodity, currency), []))
+
+    def add_price(self, price):
+        _count()
+        key = self._key(price._commodity, price._currency)
+        self._prices.setdefault(key, []).append(price)
+        return True
+
+    def remove_price(self, price):
+        _count()
+        prices = self._prices.get(self._key(price._commodity, price._currency), [])
+        if price in prices:
+            prices.remove(price)
+            return True
+        return False
+
+    def begin_edit(self):
+        self.edit_level += 1
+
+    def commit_edit(self):
+        self.edit_level -= 1
+
+
+class Book:
+    def __init__(self):
+        self._accounts = {}
+        self._transactions = {}
+        self._table = GncCommodityTable(self)
+        self._price_db = GncPriceDB(self)
+        eur = GncCommodity(self, "Euro", "CURRENCY", "EUR", "978", 100)
+        self._table.insert(eur)
+        for mnemonic, name in (("USD", "US Dollar"), ("CHF", "Swiss Franc")):
+            self._table.insert(GncCommodity(self, name, "CURRENCY", mnemonic, "", 100))
+        self._root = Account(self)
+        self._root._name = "Root Account"
+        self._root._is_root = True
+
+    def get_root_account(self):
+        return self._root
+
+    def get_table(self):
+        return self._table
+
+    def get_price_db(self):
+        return self._price_db
+
+
+class Session:
+    """Books are kept as pickle files, a path that does not exist starts an empty book"""
+
+    def __init__(self, path=None, *args, **kwargs):
+        # like GnuCash, a book may be given as URL
+        self.sql = bool(path and path.startswith("sqlite3://"))
+        for scheme in ("xml://", "sqlite3://", "file://"):
+            if path and path.startswith(scheme):
+                path = path[len(scheme):]
+        self.path = path
+        self.saved = 0
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                self.book = pickle.load(f)
+        else:
+            self.book = Book()
+
+    def save(self):
+        self.saved += 1
+        if self.path:
+            with open(self.path, "wb") as f:
+                pickle.dump(self.book, f)
+
+    def end(self):
+        # the SQL backend removes its lock from the book when the session ends
+        if self.sql and os.path.exists(self.path):
+            os.utime(self.path)
+
+
+class Account:
+    def __init__(self, book):
+        self._book = book
+        self._guid = GUID()
+        self._name = ""
+        self._description = ""
+        self._type = ACCT_TYPE_ASSET
+        self._commodity = None
+        self._children = []
+        self._parent = None
+        self._splits = []
+        self._lots = []
+        self._is_root = False
+        self.edit_level = 0
+        book._accounts[self._guid.value] = self
+
+    def get_instance(self):
+        return self
+
+    def GetGUID(self):
+        return self._guid
+
+    def SetName(self, name):
+        self._name = name
+
+    def GetName(self):
+        _count()
+        return self._name
+
+    def SetDescription(self, description):
+        self._description = description
+
+    def GetDescription(self):
+        _count()
+        return self._description
+
+    def SetType(self, account_type):
+        self._type = account_type
+
+    def GetType(self):
+        return self._type
+
+    def SetCommodity(self, commodity):
+        self._commodity = commodity
+
+    def GetCommodity(self):
+        _count()
+        return self._commodity
+
+    def BeginEdit(self):
+        self.edit_level += 1
+
+    def CommitEdit(self):
+        self.edit_level -= 1
+
+    def get_children(self):
+        _count()
+        return list(self._children)
+
+    def get_parent(self):
+        return self._parent
+
+    def append_child(self, child):
+        _count()
+        child._parent = self
+        self._children.append(child)
+
+    def lookup_by_name(self, name):
+        _count()
+        for child in self._children:
+            if child._name == name:
+                return child
+        for child in self._children:
+            found = child.lookup_by_name(name)
+            if found:
+                return found
+        return None
+
+    def get_full_name(self):
+        _count()
+        names = []
+        acc = self
+        while acc is not None and not acc._is_root:
+            names.append(acc._name)
+            acc = acc._parent
+        return ".".join(reversed(names))
+
+    def SortSplits(self, force):
+        _count()
+        self._splits.sort(key=lambda s: (s._parent._date, s._parent._num, s._parent._entered))
+
+    def GetSplitList(self):
+        _count()
+        return list(self._splits)
+
+    def GetBalance(self):
+        total = sum(s._amount._num / s._amount._denom for s in self._splits)
+        return GncNumeric(int(round(total * 100)), 100)
+
+    def GetLotList(self):
+        return list(self._lots)
+
+    def InsertLot(self, lot):
+        lot._account = self
+        self._lots.append(lot)
+
+
+class GncLot:
+    def __init__(self, book):
+        self._book = book
+        self._splits = []
+        self._account = None
+        self._title = ""
+
+    def add_split(self, split):
+        _count()
+        if split._lot is not None:
+            split._lot._splits.remove(split)
+        split._lot = self
+        self._splits.append(split)
+
+    def get_split_list(self):
+        return list(self._splits)
+
+    def get_balance(self):
+        num = sum(s._amount._num * 1000000 // s._amount._denom for s in self._splits)
+        return GncNumeric(num, 1000000)
+
+    def is_closed(self):
+        return self.get_balance()._num == 0
+
+    def get_account(self):
+        return self._account
+
+    def set_title(self, title):
+        self._title = title
+
+    def get_title(self):
+        return self._title
+
+
+class Transaction:
+    _entered_counter = itertools.count()
+
+    def __init__(self, book):
+        self._book = book
+        self._guid = GUID()
+        self._date = datetime(1970, 1, 1, 10, 59)
+        self._entered = next(Transaction._entered_counter)
+        self._description = ""
+        self._num = ""
+        self._notes = ""
+        self._currency = None
+        self._splits = []
+        self.edit_level = 0
+        self._saved = None
+        book._transactions[self._guid.value] = self
+
+    def GetGUID(self):
+        return self._guid
+
+    def BeginEdit(self):
+        _count()
+        if self.edit_level == 0:
+            # state restored by RollbackEdit
+            self._saved = (self._date, self._description, self._num, self._notes, self._currency,
+                           [(split, split._account, split._value, split._amount) for split in self._splits])
+        self.edit_level += 1
+
+    def CommitEdit(self):
+        global commits
+        _count()
+        self.edit_level -= 1
+        if self.edit_level == 0:
+            self._saved = None
+            commits += 1
+
+    def RollbackEdit(self):
+        _count()
+        self.edit_level -= 1
+        if self.edit_level > 0 or self._saved is None:
+            return
+        self._date, self._description, self._num, self._notes, self._currency, splits = self._saved
+        self._saved = None
+        kept = set(split for split, _, _, _ in splits)
+        for split in list(self._splits):
+            if split not in kept:
+                split.Destroy()
+        for split, account, value, amount in splits:
+            if split._account is not account:
+                split.SetAccount(account)
+            split._value = value
+            split._amount = amount
+
+    def IsOpen(self):
+        return self.edit_level > 0
+
+    def SetDateEnteredSecs(self, date):
+        pass
+
+    def SetDate(self, day, month, year):
+        _count()
+        self._date = datetime(year, month, day, 10, 59)
+
+    def GetDate(self):
+        _count()
+        return self._date
+
+    def SetDescription(self, description):
+        _count()
+        self._description = description
+
+    def GetDescription(self):
+        _count()
+        return self._description
+
+    def SetCurrency(self, currency):
+        _count()
+        self._currency = currency
+
+    def GetCurrency(self):
+        _count()
+        return self._currency
+
+    def SetNum(self, num):
+        _count()
+        self._num = num
+
+    def GetNum(self):
+        _count()
+        return self._num
+
+    def SetNotes(self, notes):
+        _count()
+        self._notes = notes
+
+    def GetNotes(self):
+        _count()
+        return self._notes
+
+    def GetSplitList(self):
+        _count()
+        return list(self._splits)
+
+    def Destroy(self):
+        for split in list(self._splits):
+            split.Destroy()
+        self._book._transactions.pop(self._guid.value, None)
+
+
+class Split:
+    def __init__(self, book):
+        self._book = book
+        self._guid = GUID()
+        self._parent = None
+        self._account = None
+        self._memo = ""
+        self._value = GncNumeric(0, 100)
+        self._amount = GncNumeric(0, 100)
+        self._reconcile = "n"
+        self._lot = None
+
+    def GetGUID(self):
+        return self._guid
+
+    def SetParent(self, transaction):
+        _count()
+        self._parent = transaction
+        transaction._splits.append(self)
+
+    def GetParent(self):
+        _count()
+        return self._parent
+
+    def SetAccount(self, account):
+        _count()
+        if self._account is not None:
+            self._account._splits.remove(self)
+        self._account = account
+        account._splits.append(self)
+
+    def GetAccount(self):
+        _count()
+        return self._account
+
+    def SetMemo(self, memo):
+        self._memo = memo
+
+    def GetMemo(self):
+        _count()
+        return self._memo
+
+    def SetValue(self, value):
+        _count()
+        self._value = GncNumeric(value)
+
+    def GetValue(self):
+        _count()
+        return GncNumeric(self._value)
+
+    def SetAmount(self, amount):
+        _count()
+        self._amount = GncNumeric(amount)
+
+    def GetAmount(self):
+        _count()
+        return GncNumeric(self._amount)
+
+    def GetSharePrice(self):
+        _count()
+        if self._amount._num == 0:
+            return GncNumeric(0, 1)
+        return GncNumeric(self._value._num * self._amount._denom,
+                          self._value._denom * self._amount._num)
+
+    def GetReconcile(self):
+        return self._reconcile
+
+    def GetLot(self):
+        return self._lot
+
+    def Destroy(self):
+        if self._account is not None:
+            self._account._splits.remove(self)
+        if self._parent is not None:
+            self._parent._splits.remove(self)
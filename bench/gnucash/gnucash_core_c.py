@@ -0,0 +1,19 @@
+"""Stand-in for the low level SWIG module of the gnucash bindings."""
+
+
+def string_to_guid(string, guid):
+    guid.value = string
+    return True
+
+
+event_suspend_level = 0
+
+
+def qof_event_suspend():
+    global event_suspend_level
+    event_suspend_level += 1
+
+
+def qof_event_resume():
+    global event_suspend_level
+    event_suspend_level -= 1
@@ -0,0 +1,103 @@
+"""Leveled and buffered output, set with --log-level and --log-format."""
+
+import json
+import sys
+from collections import defaultdict
+
+
+levels = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+formats = ("text", "json")
+prefixes = {"warning": "WARNING: ", "error": "ERROR: "}
+
+
+class Log:
+
+    def __init__(self, level="info", format="text", stream=None, buffer_size=1000):
+        if level not in levels:
+            raise ValueError("unknown log level " + str(level) + ", expected one of " + ", ".join(levels))
+        if format not in formats:
+            raise ValueError("unknown log format " + str(format) + ", expected one of " + ", ".join(formats))
+        self.level = levels[level]
+        self.format = format
+        # None writes to the sys.stdout of the time of the flush
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.lines = []
+        # number of messages written by flush
+        self.written = 0
+        self.counts = defaultdict(int)
+
+    def enabled(self, level):
+        return levels[level] >= self.level
+
+    def log(self, level, kind, text, **fields):
+        """Logs text, a string or a function that returns a string or a list of lines.
+        fields are only written by the json format.
+        """
+        if level in prefixes:
+            self.counts[(level, kind)] += 1
+        if levels[level] < self.level:
+            return
+        if callable(text):
+            text = text()
+        if isinstance(text, list):
+            text = "\n".join(text)
+        if self.format == "json":
+            message = {"level": level, "kind": kind, "text": text}
+            message.update(fields)
+            self.lines.append(json.dumps(message, default=str))
+        else:
+            self.lines.append(prefixes.get(level, "") + text)
+        if len(self.lines) >= self.buffer_size:
+            self.flush()
+
+    def debug(self, kind, text, **fields):
+        self.log("debug", kind, text, **fields)
+
+    def info(self, kind, text, **fields):
+        self.log("info", kind, text, **fields)
+
+    def warning(self, kind, text, **fields):
+        self.log("warning", kind, text, **fields)
+
+    def error(self, kind, text, **fields):
+        self.log("error", kind, text, **fields)
+
+    def flush(self):
+        """Writes the buffered messages, e.g. before other output"""
+        if not self.lines:
+            return
+        stream = self.stream or sys.stdout
+        stream.write("\n".join(self.lines) + "\n")
+        stream.flush()
+        self.written += len(self.lines)
+        self.lines = []
+
+    def mark(self):
+        """Returns the position after the messages so far, see discard"""
+        return self.written + len(self.lines)
+
+    def discard(self, mark):
+        """Drops the buffered messages after mark. Returns false if some of them were written already."""
+        if mark < self.written:
+            self.lines = []
+            return False
+        del self.lines[mark - self.written:]
+        return True
+
+    def summary(self):
+        """Writes the number of warnings and errors by kind, whatever the level"""
+        if not self.counts:
+            return
+        if self.format == "json":
+            counts = defaultdict(dict)
+            for (level, kind), n in self.counts.items():
+                counts[level][kind] = n
+            self.lines.append(json.dumps({"level": "summary", "kind": "summary", "counts": counts}))
+        else:
+            for level in ("warning", "error"):
+                kinds = sorted((kind, n) for (counted, kind), n in self.counts.items() if counted == level)
+                if kinds:
+                    self.lines.append(level.capitalize() + "s: " + str(sum(n for kind, n in kinds)) + " ("
+                                      + ", ".join(str(n) + " " + kind for kind, n in kinds) + ")")
+        self.flush()
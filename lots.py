@@ -0,0 +1,107 @@
+"""Positions of the stock accounts, for assigning lots with --lots.
+Shares are in millionths, costs in cents.
+"""
+
+from array import array
+
+
+methods = ("fifo", "average")
+
+
+def scale(value, num, denom):
+    """Returns value * num / denom, rounded to the nearest integer"""
+    return (2 * value * num + denom) // (2 * denom)
+
+
+class Position:
+    __slots__ = ("method", "quantities", "costs", "lots", "head", "shares", "cost", "realized", "unassigned", "last")
+
+    def __init__(self, method):
+        self.method = method
+        self.quantities = array("q")
+        self.costs = array("q")
+        self.lots = []
+        # index of the oldest open lot
+        self.head = 0
+        self.shares = 0
+        self.cost = 0
+        self.realized = 0
+        # sales that are not in a lot of the book, e.g. because they span several lots
+        self.unassigned = 0
+        # posting date of the latest split applied, later splits can be applied in order
+        self.last = None
+
+    def buy(self, shares, cost, lot):
+        """Opens lot with shares bought for cost"""
+        self.quantities.append(shares)
+        self.costs.append(cost)
+        self.lots.append(lot)
+        self.shares += shares
+        self.cost += cost
+
+    def sell(self, shares, proceeds):
+        """Takes shares sold for proceeds from the oldest lots.
+        Returns [(lot, shares)] of the lots the shares were taken from.
+        """
+        taken = []
+        fifo_basis = 0
+        remaining = shares
+        while remaining > 0 and self.head < len(self.quantities):
+            i = self.head
+            n = min(self.quantities[i], remaining)
+            lot_cost = scale(self.costs[i], n, self.quantities[i])
+            self.quantities[i] -= n
+            self.costs[i] -= lot_cost
+            fifo_basis += lot_cost
+            remaining -= n
+            taken.append((self.lots[i], n))
+            if self.quantities[i] == 0:
+                self.lots[i] = None
+                self.head += 1
+
+        sold = shares - remaining
+        if sold == 0:
+            return taken
+        if self.method == "average":
+            basis = scale(self.cost, sold, self.shares)
+        else:
+            basis = fifo_basis
+        # shares that were not held are ignored
+        self.realized += scale(proceeds, sold, shares) - basis
+        self.shares -= sold
+        self.cost -= basis
+        self.compact()
+        return taken
+
+    def compact(self):
+        """Drops the closed lots once they make up half of the arrays"""
+        if self.head > 32 and 2 * self.head > len(self.quantities):
+            del self.quantities[:self.head]
+            del self.costs[:self.head]
+            del self.lots[:self.head]
+            self.head = 0
+
+    def unrealized(self, price_cents):
+        """Returns the gain in cents if the shares were sold for price_cents each"""
+        return scale(self.shares, price_cents, 1000000) - self.cost
+
+
+class Positions:
+    """Positions by ISIN"""
+
+    def __init__(self, method="fifo"):
+        if method not in methods:
+            raise ValueError("unknown lot method " + str(method) + ", expected one of " + ", ".join(methods))
+        self.method = method
+        self.positions = {}
+
+    def get(self, isin):
+        return self.positions.get(isin)
+
+    def create(self, isin):
+        position = self.positions[isin] = Position(self.method)
+        return position
+
+    def drop(self, isin):
+        """Forgets the position of isin, e.g. after one of its splits was changed"""
+        self.positions.pop(isin, None)
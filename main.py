@@ -5,13 +5,57 @@ Usage:
   main.py [options] create-portfolio-account [(invest <invest_root>)] <isins>
   main.py [options] statement <tsv_file> [(checking <checking_root>)]
   main.py [options] ofx <ofx_file> [(checking <checking_root>)]
+  main.py [options] apply-plan <plan_file>
+  main.py [options] prices [(invest <invest_root>)]
+  main.py [options] gains [(invest <invest_root>)]
+  main.py [options] export <export_file>
+  main.py [options] report (balances | holdings | cost-basis) <export_file>
 
 Options:
   -h --help                     Show this screen.
   --version                     Show version.
   --gnucash <gnucash>           Gnucash file.
   --heuristic                   Match statements based on their date and value only.
+  --heuristic-days <n>          With --heuristic, match transactions up to n days before or after the statement date [default: 0].
   --stock-description <file>    TSV file: <ISIN> <Type: Etf, Fund, Stock, ...> <Description>
+  --stock-cache <file>          Descriptions entered at the prompt are added to this file, in the format of the
+                                description file, and read on later runs. By default next to the Gnucash file.
+  --batch-size <n>              Number of parsed rows that are applied to the book at once [default: 1000].
+  --bulk                        Keep the edits of a batch open and commit them once per batch, with engine
+                                events suspended. A failing line rolls back the edits of its batch.
+  --jobs <n>                    Number of processes parsing the input files and matching the portfolio rows
+                                of different checking accounts [default: 1].
+  --dry-run                     Match the input against the book and print the planned changes without applying them.
+  --plan <plan_file>            Write the planned actions to a file, which can be applied later with apply-plan.
+  --incremental                 Skip rows that were imported unchanged by an earlier run.
+  --state <file>                Import state for --incremental, by default next to the Gnucash file.
+                                Delete it when the book was changed by other means.
+  --snapshot                    Keep a snapshot of the splits next to the Gnucash file. A statement import that
+                                would not change the book is checked against it, without opening the book.
+  --quote-source <source>       Where prices fetches quotes: onvista, url:<template with {isin}> or dir:<directory> [default: onvista].
+  --quote-cache <file>          Cache of the fetched quotes, by default next to the Gnucash file.
+  --quote-ttl <seconds>         Fetch cached quotes again when they are older [default: 3600].
+  --fetch-jobs <n>              Number of quotes fetched at the same time [default: 8].
+  --lots <method>               Assign imported stock splits to lots, with fifo or average cost basis. gains
+                                uses fifo without it.
+  --profile                     Print the time and number of calls of every import phase.
+  --profile-out <file>          Write the profile as JSON, or as CSV if the file name ends with .csv.
+  --log-level <level>           Output the messages of this level and above: debug, info, warning or error
+                                [default: info].
+  --log-format <format>         Output the messages as text or as JSON lines [default: text].
+
+<tsv_file> and <ofx_file> may be comma separated lists of files, which are imported
+one after the other in the same session. An entry @<manifest> reads the list of files
+from the manifest file, one file per line.
+
+Statement rows are in the currency of their currency column, or in the currency of
+the account if the column does not hold a known ISO 4217 code like EUR. Portfolio rows are in the currency of their checking
+account. Amounts in another currency than their account are converted with the nearest
+exchange rate of the price database, stock purchases are balanced with the trading
+account Trading.CURRENCY.<currency>, which is created if needed.
+
+export writes the accounts, transactions, splits and prices of the book as NumPy
+arrays to <export_file> (.npz). report reads such an export, without opening a book.
 
 """
 
@@ -23,16 +67,37 @@ Options:
 from docopt import docopt
 
 import bs4
+import contextlib
+import json
+import log
+import lots
+import multiprocessing
+import os
+import sys
 import time
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import requests
-from decimal import Decimal
+from fractions import Fraction
 import gnucash as gc
-from gnucash import Account, Session, Transaction, Split, GncNumeric, GncCommodity, GncPrice, ACCT_TYPE_STOCK
+from gnucash import Account, Session, Transaction, Split, GncNumeric, GncCommodity, GncPrice, GncLot, GUID, ACCT_TYPE_STOCK, ACCT_TYPE_TRADING
+from gnucash import gnucash_core_c
+from gnucash.gnucash_core_c import string_to_guid
 from collections import defaultdict
+from bisect import bisect_left, bisect_right, insort
 
 from ofxparse import ofxparse
 
+import matching
+import quotes
+import rates
+import records
+import snapshot
+import state
+import timing
+
+# prefix of the line in the transaction notes that stores the OFX transaction id
+ofx_fitid_prefix = "OFX FITID: "
+
 translation = {
     "Aktien": "Stock",
     "Fonds": "Fund",
@@ -48,11 +113,279 @@ class CheckDescription:
     def substr(exp_desc, act_desc):
         return exp_desc in act_desc
 
+class StockCatalog:
+    """Stock descriptions from the --stock-description TSV file, keyed by ISIN.
+
+    The kinds are translated with the translation table while loading.
+    Descriptions entered at the prompt are appended to the cache file, which
+    is read after the description file. ISINs that are looked up but not
+    described are collected, so that they can be reported in one batch after
+    the import.
+    """
+
+    def __init__(self, path=None, cache_path=None):
+        self.path = path
+        self.cache_path = cache_path
+        self.entries = {}
+        self.missing = []
+        if path:
+            self.load(path)
+        if cache_path and os.path.exists(cache_path):
+            self.load(cache_path)
+
+    def load(self, path):
+        with open(path) as f:
+            for i, line in enumerate(f):
+                if not line.strip() or line.startswith("#"):
+                    continue
+                parts = [p.strip() for p in line.rstrip("\n").split("\t")]
+                if len(parts) < 3 or not all(parts[:3]):
+                    raise RuntimeError("Problem in line " + str(i+1) + " of " + str(path)
+                            + ": expected <ISIN> <Type> <Description> but got " + line)
+                isin, kind, fullname = parts[:3]
+                self.entries.setdefault(isin, (translation.get(kind, kind), fullname))
+
+    def add(self, isin, kind, fullname):
+        self.entries[isin] = (translation.get(kind, kind), fullname)
+        if isin in self.missing:
+            self.missing.remove(isin)
+        if self.cache_path:
+            with open(self.cache_path, "a") as f:
+                f.write(isin + "\t" + kind + "\t" + fullname + "\n")
+
+    def prompt(self, isins):
+        """Asks for the descriptions of all isins at once. Does nothing if the input is not a terminal."""
+        isins = [isin for isin in isins if isin not in self.entries]
+        if not isins or not sys.stdin.isatty():
+            return
+        print("No stock description for " + str(len(isins)) + " ISIN(s):")
+        for isin in isins:
+            print("  " + isin)
+        print("Enter <ISIN> <Type: Etf, Fund, Stock, ...> <Description>, one per line, an empty line to continue:")
+        while True:
+            line = input()
+            if not line.strip():
+                break
+            parts = line.strip().split("\t") if "\t" in line else line.strip().split(None, 2)
+            if len(parts) != 3 or parts[0] not in isins:
+                print("ignoring " + line)
+                continue
+            self.add(*[part.strip() for part in parts])
+
+    def lookup(self, isin):
+        """Returns (kind, name) of isin, or None if it is not described"""
+        entry = self.entries.get(isin)
+        if entry is None and isin not in self.missing:
+            self.missing.append(isin)
+        return entry
+
+    def report_missing(self, log):
+        if not self.missing:
+            return
+        log.error("no stock description", ["no stock description for " + str(len(self.missing)) + " ISIN(s), please add them to "
+                + str(self.path or "a --stock-description file") + ":"] + ["  " + isin for isin in self.missing],
+                isins=self.missing)
+
+class SplitIndex:
+    """Splits of accounts grouped by the posting date of their transaction.
+
+    An account is indexed the first time it is searched. Afterwards the index
+    is kept up to date with add(), so that a lookup only touches the splits of
+    a single day instead of the whole split list of the account.
+    """
+
+    def __init__(self):
+        self.accounts = {}
+        self.dates = {}
+
+    def load(self, account):
+        """Returns the splits of account by date and the sorted list of those dates"""
+        name = account.get_full_name()
+        by_date = self.accounts.get(name)
+        if by_date is None:
+            by_date = defaultdict(list)
+            account.SortSplits(True)
+            for split in account.GetSplitList():
+                tx = split.GetParent()
+                by_date[tx.GetDate().date()].append((split, tx))
+            self.accounts[name] = by_date
+            self.dates[name] = sorted(by_date)
+        return by_date, self.dates[name]
+
+    def lookup(self, account, date):
+        """Returns the (split, transaction) pairs of account posted on date"""
+        by_date, _ = self.load(account)
+        return by_date.get(date, [])
+
+    def lookup_range(self, account, start, end):
+        """Returns (date, pairs) for every day between start and end (inclusive) with splits, latest day first"""
+        by_date, dates = self.load(account)
+        lo = bisect_left(dates, start)
+        hi = bisect_right(dates, end)
+        return [(date, by_date[date]) for date in reversed(dates[lo:hi])]
+
+    def add(self, split, transaction, account):
+        """Registers a new split. Accounts that were not indexed yet will pick it up when they are."""
+        name = account.get_full_name()
+        by_date = self.accounts.get(name)
+        if by_date is not None:
+            date = transaction.GetDate().date()
+            if date not in by_date:
+                insort(self.dates[name], date)
+            by_date[date].append((split, transaction))
+
+class AccountRegistry:
+    """Lookup tables for accounts, built once per session.
+
+    The subtree below an account is walked the first time it is searched.
+    Afterwards ISINs, account numbers and dotted paths are resolved from
+    Python dictionaries without walking the account tree again.
+    """
+
+    def __init__(self):
+        self.subtrees = {}
+        self.paths = {}
+
+    def subtree(self, account):
+        """Returns the tables of the subtree below account"""
+        name = account.get_full_name()
+        tables = self.subtrees.get(name)
+        if tables is None:
+            tables = {"by_isin": {}, "descriptions": [], "by_number": {}}
+            self.subtrees[name] = tables
+            self.walk(account, tables)
+        return tables
+
+    def walk(self, account, tables):
+        self.register(account, tables)
+        for child in account.get_children():
+            self.walk(child, tables)
+
+    def register(self, account, tables):
+        commodity = account.GetCommodity()
+        if commodity:
+            tables["by_isin"].setdefault(commodity.get_cusip(), account)
+        tables["descriptions"].append((account.GetDescription(), account))
+        tables["by_number"].clear()
+
+    def add(self, account):
+        """Registers a newly created account in every walked subtree containing it"""
+        full_name = account.get_full_name()
+        for name, tables in self.subtrees.items():
+            if name == "" or full_name.startswith(name + "."):
+                self.register(account, tables)
+
+    def find_by_isin(self, account, isin):
+        return self.subtree(account)["by_isin"].get(isin)
+
+    def find_by_number(self, account, number):
+        tables = self.subtree(account)
+        by_number = tables["by_number"]
+        if number not in by_number:
+            by_number[number] = None
+            for description, acc in tables["descriptions"]:
+                if number in description:
+                    by_number[number] = acc
+                    break
+        return by_number[number]
+
+class BulkEdit:
+    """Edits that stay open while a batch of rows is applied, enabled with --bulk.
+
+    Every transaction touched by the batch is opened once more at the start,
+    so that the edits of the rows are nested and the transaction is committed,
+    and written by SQL backends, once per batch instead of once per row. The
+    accounts receiving new children and the price database are kept open as
+    well, and engine events are suspended if the bindings expose
+    qof_event_suspend. rollback() undoes the transactions and prices of the
+    batch; accounts created by it remain in the book.
+    """
+
+    def __init__(self, price_db, enabled=False):
+        self.price_db = price_db
+        self.enabled = enabled
+        self.active = False
+        self.transactions = {}
+        self.accounts = {}
+        self.prices = []
+
+    def begin(self):
+        if not self.enabled:
+            return
+        suspend = getattr(gnucash_core_c, "qof_event_suspend", None)
+        if suspend:
+            suspend()
+        self.price_db.begin_edit()
+        self.active = True
+
+    def hold_transaction(self, transaction, created=False):
+        """Keeps transaction open until the end of the batch"""
+        if not self.active:
+            return
+        guid = transaction.GetGUID().to_string()
+        if guid not in self.transactions:
+            transaction.BeginEdit()
+            self.transactions[guid] = (transaction, created)
+
+    def hold_account(self, account):
+        """Keeps account open until the end of the batch"""
+        if not self.active:
+            return
+        name = account.get_full_name()
+        if name not in self.accounts:
+            account.BeginEdit()
+            self.accounts[name] = account
+
+    def added_price(self, price):
+        if self.active:
+            self.prices.append(price)
+
+    def commit(self):
+        if not self.active:
+            return
+        for transaction, created in self.transactions.values():
+            transaction.CommitEdit()
+        self.end()
+
+    def rollback(self):
+        if not self.active:
+            return
+        for transaction, created in self.transactions.values():
+            if created:
+                transaction.Destroy()
+                while transaction.IsOpen():
+                    transaction.CommitEdit()
+            else:
+                # a failing line may have left its own edit open
+                while transaction.IsOpen():
+                    transaction.RollbackEdit()
+        for price in self.prices:
+            self.price_db.remove_price(price)
+        self.end()
+
+    def end(self):
+        for account in self.accounts.values():
+            account.CommitEdit()
+        self.price_db.commit_edit()
+        resume = getattr(gnucash_core_c, "qof_event_resume", None)
+        if resume:
+            resume()
+        self.active = False
+        self.transactions = {}
+        self.accounts = {}
+        self.prices = []
+
 class CashScript:
 
-    def __init__(self, session, args):
+    def __init__(self, session, args, output=None):
         self.session = session
         self.args = args
+        if output == None:
+            output = log.Log(args.get("--log-level") or "info", args.get("--log-format") or "text")
+        self.log = output
+        cache_path = args.get("--stock-cache") or book_side_file(args.get("--gnucash"), ".stocks.tsv")
+        self.stock_catalog = StockCatalog(args["--stock-description"], cache_path)
+        self.profiler = timing.Profiler(args.get("--profile"))
         if session == None:
             return
 
@@ -62,6 +395,29 @@ class CashScript:
         self.price_db = self.book.get_price_db()
 
         self.currency_EUR = self.commod_tab.lookup('ISO4217', 'EUR')
+        self.currencies = {}
+        self.rate_table = None
+        self.split_index = SplitIndex()
+        self.account_registry = AccountRegistry()
+        self.price_index = {}
+        self.batch_size = int(args.get("--batch-size") or 1000)
+        self.jobs = int(args.get("--jobs") or 1)
+        self.heuristic_days = int(args.get("--heuristic-days") or 0)
+        self.dry_run = bool(args.get("--dry-run"))
+        self.plan_file = None
+        self.plan_transactions = {}
+        self.plan_counts = defaultdict(lambda: 0)
+        self.phase_seconds = defaultdict(lambda: 0.0)
+        self.planned_statements = defaultdict(list)
+        self.planned_prices = set()
+        self.planned_splits = {}
+        self.import_state = None
+        self.bulk_edit = BulkEdit(self.price_db, bool(args.get("--bulk")) and not self.dry_run)
+        # lots are created in the book, which a dry run leaves unchanged
+        self.assign_lots = bool(args.get("--lots")) and not self.dry_run
+        self.positions = lots.Positions(args.get("--lots") or "fifo")
+        # stock splits of the import that are assigned to lots at the end of a file
+        self.pending_lots = []
 
         self.split_fmt = [
             ("{:80}", "account", lambda s: self.tostring_account(s.GetAccount())),
@@ -78,50 +434,39 @@ class CashScript:
             account = self.root
         if type(path) == str:
             path = path.split(".")
+        key = (account.get_full_name(), tuple(path))
+        found = self.account_registry.paths.get(key)
+        if found is None:
+            found = self.lookup_account(path, account)
+            self.account_registry.paths[key] = found
+        return found
+
+    def lookup_account(self, path, account):
         child_account = account.lookup_by_name(path[0])
         if child_account is None or child_account.get_instance() is None:
             raise Exception("Account " + str(path) + " not found")
         if len(path) > 1:
-            return self.find_account(path[1:], child_account)
+            return self.lookup_account(path[1:], child_account)
         return child_account
 
     def find_account_by_isin(self, account, isin):
-        if account.GetCommodity() and account.GetCommodity().get_cusip() == isin:
-            return account
-        for child in account.get_children():
-            found = self.find_account_by_isin(child, isin)
-            if found:
-                return found
+        return self.account_registry.find_by_isin(account, isin)
 
     def find_account_by_number(self, account, number):
-        if number in account.GetDescription():
-            return account
-        for child in account.get_children():
-            found = self.find_account_by_number(child, number)
-            if found:
-                return found
+        return self.account_registry.find_by_number(account, number)
 
-    def find_transaction(self, account, date, desc, props={}, idx=None, check_desc=CheckDescription.exact,
-                         warn_not_matched=True):
-        """Searches for the transaction in account with the specified date and description.
-        Additional properties might be given which restricts the search.
-        However, those are not obligatory.
-        """
-
-        account.SortSplits(True)
-        splits = account.GetSplitList()
+    def match_splits(self, pairs, desc, props, check_desc):
+        """Returns the transactions of the (split, transaction) pairs that correspond to the constraints"""
         candidates = []
 
-        def check_split(split, check_desc):
+        def check_split(split, tx):
             """Returns true if the split corresponds to the constraints"""
-            if date.date() != tx.GetDate().date():
-                return False
             if not check_desc(desc, tx.GetDescription()):
                 return False
 
             for p_name, p_val in props.items():
                 if p_name == "num":
-                    split_val = split.GetParent().GetNum()
+                    split_val = tx.GetNum()
                     if split_val == "":
                         continue
                     if split_val != p_val:
@@ -134,10 +479,20 @@ class CashScript:
 
             return True
 
-        for split in splits:
-            tx = split.GetParent()
-            if check_split(split, check_desc=check_desc):
+        self.profiler.count("splits scanned", len(pairs))
+        for split, tx in pairs:
+            if check_split(split, tx):
                 candidates.append(tx)
+        return candidates
+
+    def find_transaction(self, account, date, desc, props={}, idx=None, check_desc=CheckDescription.exact,
+                         warn_not_matched=True):
+        """Searches for the transaction in account with the specified date and description.
+        Additional properties might be given which restricts the search.
+        However, those are not obligatory.
+        """
+
+        candidates = self.match_splits(self.split_index.lookup(account, date.date()), desc, props, check_desc)
 
         if idx == None:
             len_check = lambda candidates: len(candidates) == 1
@@ -147,7 +502,7 @@ class CashScript:
 
         if not len_check(candidates):
             if warn_not_matched:
-                print("Could not find transaction " + str(desc)
+                self.log.debug("unmatched", "Could not find transaction " + str(desc)
                         + " on " + str(date.date())
                         + " because there are " + str(len(candidates)) + " candidates")
             if len(candidates) == 0:
@@ -159,6 +514,20 @@ class CashScript:
 
         return candidates[idx]
 
+    def find_transactions_in_range(self, account, start, end, desc, props={}, check_desc=CheckDescription.exact):
+        """Searches for transactions in account posted between start and end (both inclusive).
+        Returns a list of (date, candidates), the latest date first. Days without candidates are left out.
+        The candidates of a day are ordered by their number, like in find_transaction.
+        """
+        days = []
+        for date, pairs in self.split_index.lookup_range(account, start.date(), end.date()):
+            candidates = self.match_splits(pairs, desc, props, check_desc)
+            if len(candidates) > 1:
+                candidates.sort(key=lambda tx: int(tx.GetNum()))
+            if candidates:
+                days.append((date, candidates))
+        return days
+
     def find_split_by_account(self, transaction, account):
         for split in transaction.GetSplitList():
             if split.GetAccount().get_full_name() == account.get_full_name():
@@ -195,24 +564,28 @@ class CashScript:
             #+ "  balance: " + str(split.GetBalance())
             )
 
-    def print_split_row(self, split, prefix="  "):
+    def split_row(self, split, prefix="  "):
         s = prefix
         for f in self.split_fmt:
             s += f[0].format(str(f[2](split)))
-        print(s)
+        return s
 
-    def print_transaction(self, transaction):
+    def print_split_row(self, split, prefix="  "):
+        print(self.split_row(split, prefix))
+
+    def transaction_lines(self, transaction):
         if not transaction:
-            print("NO TRANSACTION")
-            return
-        print("Transaction on " + str(transaction.GetDate()) + ": " + str(transaction.GetDescription()) + " (" + str(transaction.GetNum()) + ")")
+            return ["NO TRANSACTION"]
+        lines = ["Transaction on " + str(transaction.GetDate()) + ": " + str(transaction.GetDescription()) + " (" + str(transaction.GetNum()) + ")"]
 
-        print("".join([f.format(h) for (f, h, _) in self.split_fmt]))
+        lines.append("".join([f.format(h) for (f, h, _) in self.split_fmt]))
 
         for split in transaction.GetSplitList():
-            self.print_split_row(split)
+            lines.append(self.split_row(split))
+        return lines
 
-        pass
+    def print_transaction(self, transaction):
+        print("\n".join(self.transaction_lines(transaction)))
 
     def print_accounts(self, account, prefix="  "):
         self.print_account(account, prefix)
@@ -251,29 +624,15 @@ class CashScript:
 
 
     def goc_stock_account(self, parent, isin, account_type):
+        """Search or create the account of isin. Returns None if the ISIN is not in the stock catalog."""
         acc = self.find_account_by_isin(parent, isin)
         if acc:
             return acc
 
-        fullname = None
-        namespace = None
-
-        # try to read from stock description TSV file
-        
-        stock_desc_file = self.args["--stock-description"]
-        if stock_desc_file:
-            with open(stock_desc_file) as f:
-                for line in f:
-                    parts = line.replace("\n","").split("\t")
-                    if parts[0] == isin:
-                        namespace = parts[1]
-                        fullname = parts[2]
-                        break
-        
-        if fullname == None:
-            fullname = input("Please provide a name for " + str(isin) + " (e.g., by searching on finanzen.net): ").strip()
-        if namespace == None:
-            namespace = input("Please provide the kind (Etf, Fund, Stock, etc): ").strip()
+        entry = self.stock_catalog.lookup(isin)
+        if entry == None:
+            return None
+        namespace, fullname = entry
 
         # create account
         stock_type = namespace
@@ -283,18 +642,151 @@ class CashScript:
             category.SetName(stock_type)
             category.SetType(account_type)
             category.SetCommodity(self.currency_EUR)
+            self.bulk_edit.hold_account(parent)
             parent.append_child(category)
+            self.account_registry.add(category)
 
         commodity = self.goc_stock_commodity(isin, name=fullname, namespace=namespace)
         stock_acc = Account(self.book)
         stock_acc.SetName(isin + " " + fullname)
         stock_acc.SetCommodity(commodity)
         stock_acc.SetType(account_type)
+        self.bulk_edit.hold_account(category)
         category.append_child(stock_acc)
+        self.account_registry.add(stock_acc)
 
-        print("created " + stock_acc.get_full_name())
+        self.log.info("account", "created " + stock_acc.get_full_name())
         return stock_acc
 
+    def create_stock_accounts(self, invest_root, isins):
+        """Creates the accounts of isins in one bulk step. ISINs without description are asked for
+        in one prompt, if the input is a terminal, and reported by stock_catalog.report_missing otherwise.
+        """
+        isins = [isin for isin in isins if self.find_account_by_isin(invest_root, isin) == None]
+        # the prompt comes after the messages so far
+        self.log.flush()
+        self.stock_catalog.prompt(isins)
+        if self.dry_run:
+            return
+        with self.profiler.phase("account creation"):
+            with self.bulk_batch():
+                for isin in isins:
+                    self.goc_stock_account(invest_root, isin, ACCT_TYPE_STOCK)
+
+    def prepare_portfolio_accounts(self, tsv_files, invest_root):
+        """Pre-pass of the portfolio import: creates the accounts of all ISINs of the files
+        before the first line is imported
+        """
+        isins = {}
+        for tsv_file in tsv_files:
+            for record in records.parse(tsv_file, records.PortfolioRecord, jobs=self.jobs):
+                if not records.portfolio_ignored(record):
+                    isins.setdefault(record.isin)
+        self.create_stock_accounts(invest_root, list(isins))
+
+    def position(self, account):
+        """Returns the lot position of the stock account. On first use, the splits of the account
+        are applied in date order, see apply_lot.
+        """
+        isin = account.GetCommodity().get_cusip()
+        position = self.positions.get(isin)
+        if position != None:
+            return position
+        position = self.positions.create(isin)
+        splits = [(split.GetParent().GetDate(), i, split) for i, split in enumerate(account.GetSplitList())]
+        for _, _, split in sorted(splits, key=lambda entry: entry[:2]):
+            self.apply_lot(account, position, split)
+        return position
+
+    def apply_lot(self, account, position, split):
+        """Applies the stock split to position. With --lots, a split without lot is assigned to one:
+        a purchase opens a new lot, a sale goes to the lot it is taken from.
+        """
+        amount = split.GetAmount()
+        value = split.GetValue()
+        shares = amount.num() * 1000000 // amount.denom()
+        cents = value.num() * 100 // value.denom()
+        lot = split.GetLot()
+        date = split.GetParent().GetDate()
+        if position.last == None or date > position.last:
+            position.last = date
+        if shares > 0:
+            if lot == None and self.assign_lots:
+                lot = GncLot(self.book)
+                account.InsertLot(lot)
+                lot.set_title(account.GetCommodity().get_cusip() + " " + str(split.GetParent().GetDate().date()))
+                lot.add_split(split)
+            position.buy(shares, cents, lot)
+        elif shares < 0:
+            taken = position.sell(-shares, -cents)
+            held = sum(n for _, n in taken)
+            if held < -shares:
+                self.log.warning("oversold", "the sale of " + str(-shares / 1000000) + " shares on " + str(date.date())
+                                 + " in " + account.get_full_name() + " exceeds the " + str(held / 1000000)
+                                 + " shares held", account=account.get_full_name(), date=date.date())
+            if lot != None:
+                return
+            if not self.assign_lots:
+                position.unassigned += 1
+                return
+            if len(taken) == 1 and taken[0][0] != None and taken[0][1] == -shares:
+                taken[0][0].add_split(split)
+                return
+            position.unassigned += 1
+            if len(taken) > 1:
+                self.log.warning("lot", "the sale on " + str(split.GetParent().GetDate().date()) + " in "
+                                 + account.get_full_name() + " spans " + str(len(taken)) + " lots, it is left to the GnuCash scrub")
+
+    def assign_lot(self, account, split, created):
+        """Queues a created or changed stock split for assign_pending_lots"""
+        self.pending_lots.append((account, split, created))
+
+    def assign_pending_lots(self):
+        """Applies the queued stock splits to the positions of their accounts in the order of their posting
+        dates, as the rows of a file may be newest first. A position that holds later splits or the old amount
+        of a changed split is read again from the book, which contains the queued splits.
+        """
+        pending = {}
+        for account, split, created in self.pending_lots:
+            isin = account.GetCommodity().get_cusip()
+            if isin not in pending:
+                pending[isin] = (account, [])
+            pending[isin][1].append((split.GetParent().GetDate(), split, created))
+        self.pending_lots = []
+        for isin, (account, splits) in pending.items():
+            splits.sort(key=lambda entry: entry[0])
+            position = self.positions.get(isin)
+            if position == None:
+                self.position(account)
+                continue
+            if not all(created for _, _, created in splits) or (position.last != None and splits[0][0] < position.last):
+                self.positions.drop(isin)
+                self.position(account)
+                continue
+            for _, split, _ in splits:
+                self.apply_lot(account, position, split)
+
+    def print_gains(self, invest_root):
+        """Prints the positions of the stock accounts below invest_root with their realized and unrealized gains"""
+        self.log.info("header", "{:<16}{:>16}{:>14}{:>14}{:>12}{:>14}{:>16}".format(
+                      "isin", "shares", "cost basis", "realized", "price", "unrealized", "sales w/o lot"))
+        for isin, account in sorted(self.stock_accounts(invest_root).items()):
+            position = self.position(account)
+            prices = self.stock_prices(account.GetCommodity())
+            price = ""
+            unrealized = ""
+            if prices:
+                # the latest price, of the same time the last one of the price database, like report.latest_prices
+                cents = int(max(reversed(prices), key=lambda key: key[0])[1] * 100)
+                price = "{:.2f}".format(cents / 100)
+                unrealized = "{:.2f}".format(position.unrealized(cents) / 100)
+            self.log.info("gains", "{:<16}{:>16.6f}{:>14.2f}{:>14.2f}{:>12}{:>14}{:>16}".format(
+                          isin, position.shares / 1000000, position.cost / 100, position.realized / 100, price, unrealized,
+                          position.unassigned),
+                          isin=isin, shares=position.shares / 1000000, cost=position.cost / 100,
+                          realized=position.realized / 100, price=price, unrealized=unrealized,
+                          unassigned=position.unassigned)
+
     def goc_split(self, transaction, account, value, amount):
         """Search or create a split. Returns split, isChanged."""
         changed = False
@@ -311,6 +803,7 @@ class CashScript:
             split.SetParent(transaction)
             split.SetAccount(account)
             split.SetMemo("automatic")
+            self.split_index.add(split, transaction, account)
             changed = True
         
         check = True
@@ -328,174 +821,816 @@ class CashScript:
         return self.goc_split(transaction, account, value, amount)
 
 
-    def goc_EUR_split(self, transaction, account, cents):
-        value = GncNumeric(cents, self.currency_EUR.get_fraction())
-        amount = GncNumeric(cents, self.currency_EUR.get_fraction())
+    def currency(self, mnemonic):
+        """Returns the currency of an ISO 4217 code like EUR"""
+        currency = self.known_currency(mnemonic)
+        if currency == None:
+            raise Exception("unknown currency " + str(mnemonic))
+        return currency
+
+    def known_currency(self, mnemonic):
+        """Returns the currency of an ISO 4217 code like EUR, or None if the code is not known"""
+        if mnemonic not in self.currencies:
+            self.currencies[mnemonic] = self.commod_tab.lookup('ISO4217', mnemonic.upper())
+        return self.currencies[mnemonic]
+
+    def account_currency(self, account):
+        """Returns the commodity of account if it is a currency, EUR otherwise"""
+        commodity = account.GetCommodity()
+        if commodity != None and commodity.get_namespace() in ("ISO4217", "CURRENCY"):
+            return commodity
+        return self.currency_EUR
+
+    def rates(self):
+        """Returns the exchange rates between the currencies of the price database.
+        The table is read once, so that converting a row does not query the price database.
+        """
+        if self.rate_table == None:
+            self.rate_table = rates.RateTable()
+            with self.profiler.phase("rates"):
+                for namespace in self.commod_tab.get_namespaces():
+                    if namespace not in ("ISO4217", "CURRENCY"):
+                        continue
+                    for commodity in self.commod_tab.get_commodities(namespace):
+                        for price in self.price_db.get_prices(commodity, None):
+                            currency = price.get_currency()
+                            if currency.get_namespace() not in ("ISO4217", "CURRENCY"):
+                                continue
+                            value = price.get_value()
+                            self.rate_table.add(commodity.get_mnemonic(), currency.get_mnemonic(),
+                                                price.get_time64(), Fraction(value.num(), value.denom()))
+        return self.rate_table
+
+    def convert(self, cents, source, target, datetime_date):
+        """Returns cents of the currency source in the smallest unit of target, at the rate closest to datetime_date"""
+        if source.get_unique_name() == target.get_unique_name():
+            return cents
+        rate = self.rates().rate(source.get_mnemonic(), target.get_mnemonic(), datetime_date)
+        if rate == None:
+            raise Exception("no exchange rate from " + source.get_mnemonic() + " to " + target.get_mnemonic())
+        return lots.scale(cents, rate.numerator * target.get_fraction(), rate.denominator * source.get_fraction())
+
+    def trading_account_name(self, currency):
+        return "Trading.CURRENCY." + currency.get_mnemonic()
+
+    def trading_account(self, currency):
+        """Search or create the trading account of currency, Trading.CURRENCY.<currency>"""
+        try:
+            return self.find_account(self.trading_account_name(currency))
+        except Exception:
+            pass
+        parent = self.root
+        for name in self.trading_account_name(currency).split("."):
+            account = parent.lookup_by_name(name)
+            if account is None or account.get_instance() is None:
+                account = Account(self.book)
+                account.SetName(name)
+                account.SetType(ACCT_TYPE_TRADING)
+                account.SetCommodity(currency if name == currency.get_mnemonic() else self.currency_EUR)
+                self.bulk_edit.hold_account(parent)
+                parent.append_child(account)
+                self.account_registry.add(account)
+                self.log.info("account", "created " + account.get_full_name())
+            parent = account
+        return parent
+
+    def goc_currency_split(self, transaction, account, cents, currency, datetime_date):
+        """Search or create the split of account with a value of cents of currency.
+        The amount is converted if the account is in another currency.
+        """
+        value = GncNumeric(cents, currency.get_fraction())
+        commodity = self.account_currency(account)
+        amount = GncNumeric(self.convert(cents, currency, commodity, datetime_date), commodity.get_fraction())
         return self.goc_split(transaction, account, value, amount)
 
-    def goc_stock_price(self, commodity, cents, datetime_date):
+    def stock_prices(self, commodity, currency=None):
+        """Returns the prices of commodity in currency (EUR by default) keyed by (time, value).
+        The prices are read from the price database on first use and kept up to date by goc_stock_price.
+        """
+        if currency == None:
+            currency = self.currency_EUR
+        key = (commodity.get_unique_name(), currency.get_unique_name())
+        prices = self.price_index.get(key)
+        if prices == None:
+            prices = {}
+            for price in self.price_db.get_prices(commodity, currency):
+                value = price.get_value()
+                prices[(price.get_time64(), Fraction(value.num(), value.denom()))] = price
+            self.price_index[key] = prices
+        return prices
+
+    def goc_stock_price(self, commodity, cents, datetime_date, currency=None):
+        if currency == None:
+            currency = self.currency_EUR
         # check whether entry already exists
-        for price in self.price_db.get_prices(commodity, self.currency_EUR):
-            check = price.get_time64() == datetime_date
-            check = check and price.get_value().num == cents
-            check = check and price.get_value().denom == 100
-            if check:
-                return price
+        prices = self.stock_prices(commodity, currency)
+        key = (datetime_date, Fraction(cents, 100))
+        if key in prices:
+            return prices[key]
 
         price = GncPrice(self.book)
         price.set_commodity(commodity)
-        price.set_currency(self.currency_EUR)
+        price.set_currency(currency)
         price.set_time64(datetime_date)
         price.set_value(GncNumeric(cents,100))
         self.price_db.add_price(price)
+        self.bulk_edit.added_price(price)
+        prices[key] = price
         return price
 
-    def read_ofx_transactions(self, ofx_file):
+    def upsert_prices(self, quotes):
+        """Search or create prices for an iterable of (commodity, cents, datetime_date). Returns the prices."""
+        self.price_db.begin_edit()
+        try:
+            return [self.goc_stock_price(commodity, cents, datetime_date) for commodity, cents, datetime_date in quotes]
+        finally:
+            self.price_db.commit_edit()
+
+    def stock_accounts(self, invest_root):
+        """Returns {ISIN: account} of the stock accounts below invest_root"""
+        accounts = {}
+        for isin, account in self.account_registry.subtree(invest_root)["by_isin"].items():
+            commodity = account.GetCommodity()
+            if isin and commodity.get_namespace() not in ("ISO4217", "CURRENCY"):
+                accounts[isin] = account
+        return accounts
+
+    def update_prices(self, invest_root, fetcher, cache, jobs):
+        """Fetches the quotes of the stock accounts below invest_root and adds them to the price database"""
+        accounts = self.stock_accounts(invest_root)
+
+        with self.profiler.phase("fetch"):
+            fetched = quotes.quotes(sorted(accounts), fetcher, cache, jobs)
+
+        prices = []
+        for isin, quote in sorted(fetched.items()):
+            if isinstance(quote, Exception):
+                self.log.error("no quote", "no quote for " + isin + ": " + str(quote), isin=isin)
+                continue
+            self.log.info("quote", "  " + isin + " " + str(quote.date.date()) + " " + "{:.2f}".format(quote.cents / 100)
+                          + " " + accounts[isin].get_full_name(), isin=isin, date=quote.date.date(), cents=quote.cents)
+            prices.append((accounts[isin].GetCommodity(), quote.cents, quote.date))
+        if self.dry_run:
+            return
+        with self.profiler.phase("prices"):
+            with self.bulk_batch():
+                self.upsert_prices(prices)
+
+    def ofx_fitid(self, transaction):
+        """Returns the OFX transaction id stored in the notes of transaction, or None"""
+        for line in (transaction.GetNotes() or "").splitlines():
+            if line.startswith(ofx_fitid_prefix):
+                return line[len(ofx_fitid_prefix):]
+        return None
+
+    def ofx_lookup(self, giro_acc):
+        """Returns the transactions of giro_acc by FITID, and those without FITID by (date, value)"""
+        by_fitid = {}
+        by_date_value = defaultdict(list)
+        by_date, _ = self.split_index.load(giro_acc)
+        for date, pairs in by_date.items():
+            for split, tx in pairs:
+                fitid = self.ofx_fitid(tx)
+                if fitid:
+                    by_fitid[fitid] = (split, tx)
+                else:
+                    value = split.GetValue()
+                    by_date_value[(date, Fraction(value.num(), value.denom()))].append((split, tx))
+        return by_fitid, by_date_value
+
+    def read_ofx_transactions(self, ofx_file, checking_root):
         with open(ofx_file) as fileobj:
             ofx = ofxparse.OfxParser.parse(fileobj)
 
         acc = ofx.account
-        # TODO: find/create account
-        print(acc)
-        for d in dir(acc):
-            x = getattr(acc, d)
-            if " at 0x" in repr(x):
-                continue
-            print(str(d) + "  " + str(x))
+        giro_acc = self.find_account_by_number(checking_root, acc.number)
+        if giro_acc == None:
+            self.log.error("account not found", "account " + str(acc.number) + " not found", file=ofx_file)
+            return
+        if acc.statement.currency:
+            try:
+                currency = self.currency(acc.statement.currency)
+            except Exception:
+                self.log.error("currency", "currency " + str(acc.statement.currency) + " of " + str(ofx_file)
+                               + " is not supported", file=ofx_file)
+                return
+        else:
+            currency = self.account_currency(giro_acc)
+
+        by_fitid, by_date_value = self.ofx_lookup(giro_acc)
+        for batch in records.batches(enumerate(acc.statement.transactions), self.batch_size):
+            with self.bulk_batch():
+                for i, ofx_tx in batch:
+                    try:
+                        action = self.plan_ofx_transaction(ofx_file, i+1, giro_acc, currency, ofx_tx, by_fitid,
+                                                           by_date_value)
+                        self.handle_action(action)
+                        if action["op"] == "create" and action["tx"]:
+                            by_fitid[ofx_tx.id] = (None, self.lookup_transaction(action["tx"]))
+                    except Exception as e:
+                        raise RuntimeError("Problem with transaction " + str(ofx_tx.id) + " of " + str(ofx_file)) from e
+
+    def plan_ofx_transaction(self, ofx_file, index, giro_acc, currency, ofx_tx, by_fitid, by_date_value):
+        """Matches an OFX transaction against the book without changing it. Returns the action to execute.
+        index is the position of the transaction in ofx_file.
+        """
+        datetime_date = ofx_tx.date
+        cents = int(ofx_tx.amount * currency.get_fraction())
+        action = {
+            "kind": "ofx", "op": "noop", "file": ofx_file, "lineno": index, "account": giro_acc.get_full_name(),
+            "tx": None, "fitid": ofx_tx.id, "adopt": False, "date": str(datetime_date.date()),
+            "description": ofx_tx.payee or ofx_tx.memo, "num": ofx_tx.checknum, "value": str(ofx_tx.amount),
+            "cents": cents, "currency": currency.get_mnemonic(),
+            }
+
+        tx = None
+        if ofx_tx.id in by_fitid:
+            _, tx = by_fitid[ofx_tx.id]
+        else:
+            # adopt a transaction that was entered without OFX, e.g. from a statement TSV
+            candidates = by_date_value.get((datetime_date.date(), Fraction(cents, currency.get_fraction())))
+            if candidates:
+                split, tx = candidates.pop(0)
+                by_fitid[ofx_tx.id] = (split, tx)
+                action["adopt"] = True
 
+        if not tx:
+            action["op"] = "create"
+            return action
+        action["tx"] = self.transaction_id(tx)
+        giro_currency = self.account_currency(giro_acc)
+        amount = GncNumeric(self.convert(cents, currency, giro_currency, datetime_date), giro_currency.get_fraction())
+        if action["adopt"] or self.split_changed(tx, giro_acc, GncNumeric(cents, currency.get_fraction()), amount):
+            action["op"] = "update"
+        return action
+
+    def execute_ofx_action(self, action):
+        if action["op"] not in ("create", "update"):
+            return
+        giro_acc = self.find_account(action["account"])
+        datetime_date = datetime.fromisoformat(action["date"])
+        currency = self.currency(action["currency"])
 
-    def read_statement_transactions(self, tsv_file, giro_acc):
-        with open(tsv_file) as f:
-            for i, line in enumerate(f):
-                try:
-                    self.read_statement_transaction_line(giro_acc, line)
-                except Exception as e:
-                    raise RuntimeError("Problem in line " + str(i+1) + " of " + str(tsv_file) + ": " + line) from e
+        created_timestamp = None
+        if action["op"] == "create":
+            tx = Transaction(self.book)
+            created_timestamp = datetime.now()
+        else:
+            tx = self.lookup_transaction(action["tx"])
 
-    def read_statement_transaction_line(self, giro_acc, line):
-        if line.startswith("#"):
-            return
-        row = line.rstrip("\n").split("\t")
+        self.bulk_edit.hold_transaction(tx, created=bool(created_timestamp))
+        tx.BeginEdit()
+        if created_timestamp:
+            tx.SetDateEnteredSecs(created_timestamp)
+            tx.SetDate(datetime_date.day, datetime_date.month, datetime_date.year)
+            tx.SetDescription(action["description"])
+            tx.SetCurrency(currency)
+            tx.SetNum(action["num"])
+            action["tx"] = self.transaction_id(tx)
+        if action["adopt"] or created_timestamp:
+            notes = tx.GetNotes() or ""
+            tx.SetNotes((notes + "\n" if notes else "") + ofx_fitid_prefix + action["fitid"])
+
+        split, isChanged = self.goc_currency_split(tx, giro_acc, action["cents"], currency, datetime_date)
+        if created_timestamp or action["adopt"] or isChanged:
+            info = (" date: " + action["date"]
+                + " desc: " + str(action["description"])
+                + " fitid: " + str(action["fitid"])
+                + " value: " + action["value"])
+            op = "creating" if created_timestamp else "updating"
+            self.log.info("create" if created_timestamp else "update", lambda: ["  " + op + " " + info, self.split_row(split, prefix="       ")],
+                          fitid=action["fitid"], date=action["date"], description=action["description"],
+                          value=action["value"])
+        tx.CommitEdit()
 
-        date = row[0]
-        description = row[4]
-        num = row[5]
-        value = row[7]
-        cents = int(value.replace(",",""))
+    def transaction_id(self, transaction):
+        """Returns the GUID of transaction, which identifies it in a plan"""
+        guid = transaction.GetGUID().to_string()
+        self.plan_transactions[guid] = transaction
+        return guid
+
+    def lookup_transaction(self, guid):
+        tx = self.plan_transactions.get(guid)
+        if tx == None:
+            gnc_guid = GUID()
+            string_to_guid(guid, gnc_guid.get_instance())
+            tx = gnc_guid.TransLookup(self.book)
+        if tx == None:
+            raise Exception("transaction " + guid + " not found")
+        return tx
+
+    def same_numeric(self, a, b):
+        return a.num() * b.denom() == b.num() * a.denom()
+
+    def split_changed(self, transaction, account, value, amount):
+        """Returns true if goc_split would create or change the split of account"""
+        if account == None:
+            return True
+        split = self.find_split_by_account(transaction, account)
+        if split == None:
+            return True
+        return not (self.same_numeric(split.GetAmount(), amount) and self.same_numeric(split.GetValue(), value))
 
+    @contextlib.contextmanager
+    def bulk_batch(self):
+        """Applies a batch of rows within one bulk edit, see BulkEdit. Does nothing without --bulk."""
+        self.bulk_edit.begin()
+        mark = self.log.mark()
         try:
-            datetime_date = datetime.fromisoformat(date)
-        except Exception as e:
-            print("Ignoring record because of erroneous date: " + str(date))
+            yield
+        except BaseException:
+            if self.bulk_edit.active:
+                # the messages of the batch report changes that are undone
+                if self.log.discard(mark):
+                    self.log.error("rollback", "the changes of the batch were rolled back")
+                else:
+                    self.log.error("rollback", "the changes of the batch were rolled back, also those reported above")
+            self.bulk_edit.rollback()
+            # the indexes may refer to splits and prices that were rolled back
+            self.split_index = SplitIndex()
+            self.price_index = {}
+            raise
+        finally:
+            # the messages of a batch are written at once
+            self.log.flush()
+        self.bulk_edit.commit()
+
+    def apply_batches(self, batches, tsv_file, plan_record, reconcile=None):
+        """Plans the batches of parsed records with plan_record and executes the actions, unless in dry-run mode.
+        If reconcile is given, the actions of a batch are planned first and completed together by reconcile.
+        """
+        for batch in batches:
+            with self.bulk_batch():
+                self.apply_batch(batch, tsv_file, plan_record, reconcile)
+
+    def apply_batch(self, batch, tsv_file, plan_record, reconcile):
+        planned = []
+        for record in batch:
+            self.profiler.start_line()
+            try:
+                start = time.perf_counter()
+                action = plan_record(record)
+                self.phase_seconds["matching"] += time.perf_counter() - start
+                if reconcile == None:
+                    self.handle_action(action)
+                else:
+                    planned.append((record, action))
+            except Exception as e:
+                raise records.line_error(tsv_file, record.lineno, record.line, self.profiler.line_context()) from e
+        if not planned:
+            return
+
+        start = time.perf_counter()
+        with self.profiler.phase("reconcile"):
+            reconcile([action for record, action in planned])
+        self.phase_seconds["matching"] += time.perf_counter() - start
+        for record, action in planned:
+            self.profiler.start_line()
+            try:
+                self.handle_action(action)
+            except Exception as e:
+                raise records.line_error(tsv_file, record.lineno, record.line, self.profiler.line_context()) from e
+
+    def handle_action(self, action):
+        self.plan_counts[action["op"]] += 1
+        if action["op"] in ("noop", "unchanged"):
+            self.log.debug(action["op"], lambda: action["op"] + " " + str(action["file"]) + ":" + str(action["lineno"]),
+                           file=action["file"], lineno=action["lineno"], tx=action["tx"])
+        if self.plan_file:
+            self.plan_file.write(json.dumps(action) + "\n")
+        if self.dry_run:
+            self.print_action(action)
+            return
+        start = time.perf_counter()
+        self.execute_action(action)
+        self.phase_seconds["writing"] += time.perf_counter() - start
+        if self.import_state and "hash" in action and action["op"] in ("create", "update", "noop"):
+            self.import_state.record(action["hash"], action["kind"], action["state_account"], action["op"],
+                                     action["tx"], action["date"])
+
+    def track_imported(self, rows, kind, account, states):
+        """With --incremental, yields the records of rows and fills states with {line number: (hash, stored result)}
+        as they pass, see imported_row. The stored result is None if the row was not imported before.
+        """
+        if not self.import_state:
+            yield from rows
+            return
+        # count identical lines, for telling them apart in the import state
+        occurrences = defaultdict(lambda: 0)
+        for record in rows:
+            occurrences[record.line] += 1
+            row_hash = self.import_state.row_hash(kind, account, record.line, occurrences[record.line])
+            imported = self.import_state.lookup(row_hash)
+            if imported and imported[1]:
+                try:
+                    self.lookup_transaction(imported[1])
+                except Exception:
+                    # the transaction was deleted from the book since, the row is imported again
+                    imported = None
+            states[record.lineno] = (row_hash, imported)
+            yield record
+
+    def imported_row(self, action, account, record, states):
+        """With --incremental, returns the stored result (op, tx) if the row was imported by an earlier run
+        and its transaction is still in the book
+        """
+        if not self.import_state:
+            return None
+        action["state_account"] = account
+        action["hash"], imported = states.pop(record.lineno)
+        return imported
+
+    def unimported(self, rows, states):
+        """Returns the records of rows that track_imported found no stored result for"""
+        return [record for record in rows if record.lineno not in states or not states[record.lineno][1]]
+
+    def print_watermark(self, kind, account):
+        if not self.import_state:
+            return
+        watermark = self.import_state.watermark(kind, account)
+        if watermark:
+            self.log.info("watermark", "  " + str(watermark[1]) + " rows up to " + watermark[0] + " were imported before")
+
+    def execute_action(self, action):
+        if action["kind"] == "statement":
+            self.execute_statement_action(action)
+        elif action["kind"] == "portfolio":
+            self.execute_portfolio_action(action)
+        elif action["kind"] == "ofx":
+            self.execute_ofx_action(action)
+        else:
+            raise Exception("unknown action " + str(action["kind"]))
+
+    def apply_plan(self, plan_file):
+        """Executes the actions of a plan written with --plan, without matching the records again"""
+        with open(plan_file) as f:
+            for batch in records.batches(enumerate(f), self.batch_size):
+                with self.bulk_batch():
+                    for i, line in batch:
+                        try:
+                            self.handle_action(json.loads(line))
+                        except Exception as e:
+                            raise records.line_error(plan_file, i+1, line) from e
+        with self.profiler.phase("lots"):
+            self.assign_pending_lots()
+
+    def print_action(self, action):
+        op = action["op"]
+        if op not in ("create", "update"):
+            return
+        where = str(action["file"]) + ":" + str(action["lineno"])
+        if action["kind"] == "ofx":
+            info = (where + " " + action["date"] + " " + str(action["description"]) + " fitid: " + str(action["fitid"])
+                    + " value: " + action["value"])
+            self.log.info("plan", ("+ " if op == "create" else "~ ") + info, op=op, file=action["file"],
+                          lineno=action["lineno"], fitid=action["fitid"])
+        elif action["kind"] == "statement":
+            info = (where + " " + action["date"] + " " + action["description"]
+                    + " num: " + action["num"] + " value: " + action["value"])
+            if op == "create":
+                self.log.info("plan", "+ " + info, op=op, file=action["file"], lineno=action["lineno"])
+            else:
+                self.log.info("plan", "~ " + info + " (" + ", ".join(action["changes"]) + ")",
+                              op=op, file=action["file"], lineno=action["lineno"], changes=action["changes"])
+        else:
+            splits = [(sp["account"] or sp["isin"]) + " " + "/".join(map(str, sp["value"])) for sp in action["splits"]]
+            self.log.info("plan", "~ " + where + " " + action["date"] + " " + action["isin"] + ": " + ", ".join(splits),
+                          op=op, file=action["file"], lineno=action["lineno"], splits=action["splits"])
+
+    def snapshot_splits(self):
+        """Returns the splits of all accounts in the format of snapshot.write"""
+        splits = []
+        stack = [self.root]
+        while stack:
+            account = stack.pop()
+            stack.extend(account.get_children())
+            name = account.get_full_name()
+            for split in account.GetSplitList():
+                tx = split.GetParent()
+                value = split.GetValue()
+                amount = split.GetAmount()
+                currency = tx.GetCurrency()
+                splits.append((name, tx.GetDate().date().toordinal(), (value.num(), value.denom()),
+                               (amount.num(), amount.denom()), tx.GetDescription(), tx.GetNum(),
+                               currency.get_unique_name() if currency else "", tx.GetGUID().to_string()))
+        return splits
+
+    def print_plan_summary(self):
+        if not self.plan_counts:
             return
+        self.log.info("plan summary", "Plan: " + ", ".join(str(n) + " " + op for op, n in sorted(self.plan_counts.items()))
+                + " (matching " + "{:.2f}".format(self.phase_seconds["matching"]) + "s"
+                + ", writing " + "{:.2f}".format(self.phase_seconds["writing"]) + "s)", counts=self.plan_counts)
+        self.log.flush()
 
-        props = {"num": num, "value": GncNumeric(cents, self.currency_EUR.get_fraction())}
+    def read_statement_transactions(self, tsv_file, giro_acc):
+        # import state of the rows, see track_imported
+        states = {}
+        self.print_watermark("statement", giro_acc.get_full_name())
+
+        rows = records.parse(tsv_file, records.StatementRecord, jobs=self.jobs)
+        rows = records.filter_statement_records(rows, self.log)
+        rows = self.profiler.timed_iter("parsing", rows)
+        rows = self.track_imported(rows, "statement", giro_acc.get_full_name(), states)
+        matches = None
+        if self.args.get("--heuristic"):
+            # the lines of the whole file are assigned at once, except those imported before
+            rows = list(rows)
+            taken = set(imported[1] for _, imported in states.values() if imported and imported[1])
+            with self.profiler.phase("matching"):
+                matches = self.match_statement_heuristic(giro_acc, self.unimported(rows, states), taken)
+        self.apply_batches(records.batches(rows, self.batch_size), tsv_file,
+                lambda record: self.plan_statement_record(tsv_file, giro_acc, record, states, matches))
+
+    def match_statement_heuristic(self, giro_acc, rows, taken=()):
+        """Returns {line number: transaction or list of candidates} for the statement records rows,
+        matched on their value and date only. The transactions with a GUID in taken are left out.
+        """
+        if not rows:
+            return {}
+        tolerance = timedelta(days=self.heuristic_days)
+        start = min(record.datetime_date for record in rows).date() - tolerance
+        end = max(record.datetime_date for record in rows).date() + tolerance
+        matcher = matching.HeuristicMatcher(self.heuristic_days)
+        values = set()
+        for record in rows:
+            value = Fraction(record.cents, self.statement_currency(giro_acc, record).get_fraction())
+            values.add(value)
+            matcher.add_line(record.lineno, record.datetime_date.date(), value, record.description, record.num)
+        transactions = []
+        for date, pairs in self.split_index.lookup_range(giro_acc, start, end):
+            self.profiler.count("splits scanned", len(pairs))
+            for split, tx in pairs:
+                value = split.GetValue()
+                value = Fraction(value.num(), value.denom())
+                # splits with a value that is not in the file can not match
+                if value not in values:
+                    continue
+                if taken and tx.GetGUID().to_string() in taken:
+                    continue
+                matcher.add_candidate(len(transactions), date, value, tx.GetDescription(), tx.GetNum())
+                transactions.append(tx)
+        matches = {}
+        for lineno, candidate in matcher.assign().items():
+            matches[lineno] = [] if candidate is matching.AMBIGUOUS else transactions[candidate]
+        return matches
+
+    def statement_currency(self, giro_acc, record):
+        """Returns the currency of a statement record, the currency of giro_acc if its currency column
+        does not hold a known ISO 4217 code
+        """
+        currency = self.known_currency(record.currency) if record.currency else None
+        if currency != None:
+            return currency
+        return self.account_currency(giro_acc)
+
+    def find_planned_statement(self, action, check_desc):
+        """Returns the line of a transaction planned for creation (in dry-run mode) that matches action"""
+        for planned in self.planned_statements[(action["account"], action["date"])]:
+            if not check_desc(action["description"], planned["description"]):
+                continue
+            if planned["num"] != "" and planned["num"] != action["num"]:
+                continue
+            if planned["cents"] == action["cents"]:
+                return planned["lineno"]
+        return None
+
+    def plan_statement_record(self, tsv_file, giro_acc, record, states, matches=None):
+        """Matches a statement record against the book without changing it. Returns the action to execute.
+        matches are the transactions found by match_statement_heuristic, if given.
+        """
+        num = record.num
+        cents = record.cents
+        datetime_date = record.datetime_date
+        action = {
+            "kind": "statement", "op": "noop", "file": tsv_file, "lineno": record.lineno,
+            "account": giro_acc.get_full_name(), "tx": None, "changes": [],
+            "date": record.date, "description": record.description, "num": num,
+            "value": record.value, "cents": cents, "currency": None,
+            }
+        imported = self.imported_row(action, action["account"], record, states)
+        if imported:
+            action["op"] = "unchanged"
+            action["tx"] = imported[1]
+            return action
+
+        currency = self.statement_currency(giro_acc, record)
+        action["currency"] = currency.get_mnemonic()
+        value = GncNumeric(cents, currency.get_fraction())
+        props = {"num": num, "value": value}
         if "--heuristic" in self.args and self.args["--heuristic"]:
             check_desc = CheckDescription.ignore
         else:
             check_desc = CheckDescription.exact
-        tx = self.find_transaction(giro_acc, datetime_date, description, props, check_desc=check_desc)
+        if matches != None:
+            tx = matches.get(record.lineno)
+        else:
+            with self.profiler.phase("matching"):
+                tx = self.find_transaction(giro_acc, datetime_date, record.description, props, check_desc=check_desc)
 
         if type(tx) == list:
-            print("ERROR: Multiple candidates, ignoring")
+            self.log.error("multiple candidates", "Multiple candidates for " + record.line.rstrip("\n") + ", ignoring",
+                           file=tsv_file, lineno=record.lineno)
+            action["op"] = "error"
+            return action
+
+        if not tx:
+            # with --heuristic every line without a match is a transaction of its own
+            if self.dry_run and matches == None and self.find_planned_statement(action, check_desc) != None:
+                return action
+            action["op"] = "create"
+            if self.dry_run:
+                self.planned_statements[(action["account"], action["date"])].append(action)
+            return action
+
+        action["tx"] = self.transaction_id(tx)
+        changes = action["changes"]
+        if tx.GetDescription() != record.description:
+            changes.append("description")
+        if not tx.GetCurrency() or tx.GetCurrency().get_unique_name() != currency.get_unique_name():
+            changes.append("currency")
+        if tx.GetNum() != num:
+            changes.append("num")
+        giro_currency = self.account_currency(giro_acc)
+        amount = GncNumeric(self.convert(cents, currency, giro_currency, datetime_date), giro_currency.get_fraction())
+        if self.split_changed(tx, giro_acc, value, amount):
+            changes.append("value")
+        if changes:
+            action["op"] = "update"
+        return action
+
+    def execute_statement_action(self, action):
+        if action["op"] not in ("create", "update"):
             return
+        giro_acc = self.find_account(action["account"])
+        datetime_date = datetime.fromisoformat(action["date"])
+        description = action["description"]
+        num = action["num"]
+        currency = self.currency(action["currency"])
 
         created_timestamp = None
-        updated = False
-        if not tx:
+        if action["op"] == "create":
             tx = Transaction(self.book)
             created_timestamp = datetime.now()
+            # stored by the import state
+            action["tx"] = self.transaction_id(tx)
+        else:
+            tx = self.lookup_transaction(action["tx"])
 
+        self.bulk_edit.hold_transaction(tx, created=bool(created_timestamp))
         tx.BeginEdit()
         if created_timestamp:
             tx.SetDateEnteredSecs(created_timestamp)
-
-        tx.SetDate(datetime_date.day, datetime_date.month, datetime_date.year)
+            # matched transactions keep their date, with --heuristic-days it may differ from the statement
+            tx.SetDate(datetime_date.day, datetime_date.month, datetime_date.year)
         tx.SetDescription(description)
-        if not tx.GetCurrency() or tx.GetCurrency().get_unique_name() != self.currency_EUR.get_unique_name():
-            updated = True
-            tx.SetCurrency(self.currency_EUR)
+        if created_timestamp or "currency" in action["changes"]:
+            tx.SetCurrency(currency)
         if tx.GetNum() != num:
-            updated = True
             tx.SetNum(num)
 
-        split, isChanged = self.goc_EUR_split(tx, giro_acc, cents)
-        if created_timestamp or updated or isChanged:
-            info = (" date: " + str(date)
-                + " desc: " + str(description)
-                + " num: " + str(num)
-                + " value: " + str(value))
-            if created_timestamp:
-                print("  creating " + info)
-            else:
-                print("  updating " + info)
-            self.print_split_row(split, prefix="       ")
+        with self.profiler.phase("split upserts"):
+            split, isChanged = self.goc_currency_split(tx, giro_acc, action["cents"], currency, datetime_date)
+        if not (created_timestamp or action["changes"] or isChanged):
+            tx.CommitEdit()
+            return
+        info = (" date: " + str(action["date"])
+            + " desc: " + str(description)
+            + " num: " + str(num)
+            + " value: " + str(action["value"]))
+        op = "creating" if created_timestamp else "updating"
+        self.log.info("create" if created_timestamp else "update", lambda: ["  " + op + " " + info, self.split_row(split, prefix="       ")],
+                      file=action["file"], lineno=action["lineno"], date=action["date"], description=description,
+                      num=num, value=action["value"])
         tx.CommitEdit()
 
 
     def read_portfolio_transactions(self, tsv_file, checking_root, invest_root):
-        with open(tsv_file) as f:
-            # count how many transactions we have seen on the same day with the same description
-            tx_to_id = defaultdict(lambda: 0)
-
-            for i, line in enumerate(f):
-                if line.startswith("#"):
-                    continue
-                try:
-                    self.read_portfolio_transaction_line(tsv_file, checking_root, invest_root, line, tx_to_id)
-                except Exception as e:
-                    raise RuntimeError("Problem in line " + str(i+1) + " of " + str(tsv_file) + ": " + line) from e
-
-
-    def read_portfolio_transaction_line(self, tsv_file, checking_root, invest_root, line, tx_to_id):
-        row = line.rstrip("\n").split("\t")
-
-        acc_number = row[0]
-        entry_date = row[1]
-        valuta_date = row[2]
-        isin = row[3]
-        description = row[4]
-        nominal = row[5]
-        transaction_info = row[7]
-        price = row[9]
-        depot = row[10]
-
-        stock_count = Decimal(nominal.replace(",","."))
-        stock_price = Decimal(price.replace(",","."))
-        stock_cents = int(stock_price * 100)
-        total_stock_cents = int(stock_count * stock_price * 100)
-
-        if total_stock_cents == 0 or "Dividendenzahlung" in transaction_info or "Erträgnisausschüttung" in transaction_info:
-            print("WARNING: ignoring " + str(line.rstrip("\n")))
-            return
-
-        if "Lagerstellenwechsel" in transaction_info:
-            print("WARNING: ignoring " + str(line.rstrip("\n")))
-            return
-
-        if "WP-Ausbuchung" in transaction_info:
-            print("WARNING: ignoring " + str(line.rstrip("\n")))
-            return
-
-        if "Spin Off in" in transaction_info:
-            print("WARNING: ignoring " + str(line.rstrip("\n")))
-            return
-
-
-        # parse date
-        datetime_date = datetime.fromisoformat(entry_date)
-        datetime_valuta = datetime.fromisoformat(valuta_date)
+        # count how many transactions we have seen on the same day with the same description
+        tx_to_id = defaultdict(lambda: 0)
+        # import state of the rows, see track_imported
+        states = {}
+        state_account = checking_root.get_full_name() + ";" + invest_root.get_full_name()
+        self.print_watermark("portfolio", state_account)
+
+        rows = records.parse(tsv_file, records.PortfolioRecord, jobs=self.jobs)
+        rows = records.filter_portfolio_records(rows, self.log, tsv_file)
+        rows = self.profiler.timed_iter("parsing", rows)
+        rows = self.track_imported(rows, "portfolio", state_account, states)
+        matches = None
+        if self.jobs > 1:
+            # the accounts are matched at once, in parallel, except the rows imported before
+            rows = list(rows)
+            with self.profiler.phase("matching"):
+                matches = self.match_portfolio_partitions(checking_root, self.unimported(rows, states))
+        self.apply_batches(records.batches(rows, self.batch_size), tsv_file,
+                lambda record: self.plan_portfolio_record(tsv_file, checking_root, invest_root, record, tx_to_id,
+                                                          state_account, states, matches),
+                self.reconcile_portfolio_actions)
+        with self.profiler.phase("lots"):
+            self.assign_pending_lots()
+
+    def match_portfolio_partitions(self, checking_root, rows):
+        """Returns {line number: candidates} for the portfolio records rows, the transactions that
+        find_transactions_in_range finds on the latest day with candidates.
+        The rows are partitioned by their checking account. The descriptions of the splits of every
+        account within the date ranges of its rows are copied into a read-only snapshot, and the
+        partitions are matched against their snapshots with --jobs processes.
+        """
+        partitions = {}
+        for record in rows:
+            giro_acc = self.find_account_by_number(checking_root, record.acc_number)
+            if giro_acc == None:
+                continue
+            name = giro_acc.get_full_name()
+            if name not in partitions:
+                partitions[name] = (giro_acc, [])
+            first = min(record.datetime_date, record.datetime_valuta).date().toordinal()
+            last = max(record.datetime_date, record.datetime_valuta).date().toordinal()
+            partitions[name][1].append((record.lineno, first, last, record.isin))
+
+        transactions = []
+        tasks = []
+        for giro_acc, account_rows in partitions.values():
+            # only the days within the range of a row are copied
+            ranges = []
+            for lineno, first, last, isin in sorted(account_rows, key=lambda row: row[1]):
+                if ranges and first <= ranges[-1][1] + 1:
+                    ranges[-1][1] = max(ranges[-1][1], last)
+                else:
+                    ranges.append([first, last])
+            days = {}
+            for first, last in ranges:
+                for day, pairs in self.split_index.lookup_range(giro_acc, date.fromordinal(first), date.fromordinal(last)):
+                    self.profiler.count("splits scanned", len(pairs))
+                    entries = days[day.toordinal()] = []
+                    for split, tx in pairs:
+                        entries.append((tx.GetDescription(), len(transactions)))
+                        transactions.append(tx)
+            tasks.append((days, account_rows))
+
+        if len(tasks) > 1:
+            with multiprocessing.Pool(min(self.jobs, len(tasks))) as pool:
+                results = list(pool.imap_unordered(matching.match_portfolio_partition, tasks))
+        else:
+            results = [matching.match_portfolio_partition(task) for task in tasks]
+        matches = {}
+        for result in results:
+            for lineno, indices in result:
+                candidates = [transactions[i] for i in indices]
+                # ordered by their number, like in find_transactions_in_range
+                if len(candidates) > 1:
+                    candidates.sort(key=lambda tx: int(tx.GetNum()))
+                matches[lineno] = candidates
+        return matches
+
+
+    def plan_portfolio_record(self, tsv_file, checking_root, invest_root, record, tx_to_id, state_account, states,
+                              matches=None):
+        """Matches a portfolio record against the book without changing it. Returns the action to execute.
+        matches are the candidates found by match_portfolio_partitions, if given.
+        """
+        line = record.line
+        acc_number = record.acc_number
+        isin = record.isin
+        transaction_info = record.transaction_info
+        stock_count = record.stock_count
+        stock_cents = record.stock_cents
+        total_stock_cents = record.total_stock_cents
+        datetime_date = record.datetime_date
+        datetime_valuta = record.datetime_valuta
+        action = {
+            "kind": "portfolio", "op": "error", "file": tsv_file, "lineno": record.lineno, "line": line,
+            "tx": None, "invest_root": invest_root.get_full_name(), "isin": isin,
+            "date": record.entry_date, "stock_cents": stock_cents, "price_exists": False, "splits": [],
+            }
+        # rows of different accounts never share a transaction
+        key = (acc_number, datetime_date.date(), transaction_info)
+        imported = self.imported_row(action, state_account, record, states)
+        if imported:
+            # the row matched a transaction before, later rows of the same day need the next one
+            tx_to_id[key] += 1
+            action["op"] = "unchanged"
+            action["tx"] = imported[1]
+            return action
 
         # find accounts
-        giro_acc = self.find_account_by_number(checking_root, acc_number)
+        with self.profiler.phase("account resolution"):
+            giro_acc = self.find_account_by_number(checking_root, acc_number)
+            assets_acc = self.find_account_by_isin(invest_root, isin)
+            fee_acc = self.find_account("Expenses.Services.Broker", self.root)
         if giro_acc == None:
-            print("ERROR: account " + str(acc_number) + " not found")
-            return
-
-        assets_acc = self.goc_stock_account(invest_root, isin, ACCT_TYPE_STOCK)
-        fee_acc = self.find_account("Expenses.Services.Broker", self.root)
-        currency_acc = self.find_account("Trading.CURRENCY.EUR", self.root)
-        stock_commodity = assets_acc.GetCommodity()
+            self.log.error("account not found", "account " + str(acc_number) + " not found",
+                           file=tsv_file, lineno=record.lineno)
+            return action
+        # the prices of the depot are in the currency of its checking account
+        currency = self.account_currency(giro_acc)
+        action["currency"] = currency.get_mnemonic()
+
+        if assets_acc == None and self.stock_catalog.lookup(isin) == None:
+            # reported by stock_catalog.report_missing after the import
+            action["op"] = "skip"
+            return action
 
         # find transaction
         # unfortunately the dates may not be precise enough ...
@@ -503,69 +1638,274 @@ class CashScript:
         search_date = max(datetime_date, datetime_valuta)
         search_until = min(datetime_date, datetime_valuta)
         def check_desc(exp_desc, act_desc):
-            if "Erträgnisausschüttung" in act_desc or "Dividendenzahlung" in act_desc:
+            if any(word in act_desc for word in matching.distribution_words):
                 return False
             return CheckDescription.substr(exp_desc, act_desc)
 
-        while search_date >= search_until:
-            key = (datetime_date.date(), transaction_info)
-            tx = self.find_transaction(giro_acc, search_date, isin, idx=tx_to_id[key], check_desc=check_desc, warn_not_matched=False)
-
-            if tx:
-                break
-            search_date -= timedelta(days=1)
+        if matches != None:
+            candidates = matches.get(record.lineno)
+        else:
+            with self.profiler.phase("matching"):
+                days = self.find_transactions_in_range(giro_acc, search_until, search_date, isin, check_desc=check_desc)
+            # the latest day with candidates wins
+            candidates = days[0][1] if days else None
+        # later rows of the same account, day and kind take the next candidate
+        tx = candidates[tx_to_id[key]] if candidates else None
 
-        if not tx or type(tx) == list:
-            print("ERROR: transaction not found for " + line)
-            print("transaction info: " + str(transaction_info))
-            return
+        if not tx:
+            self.log.error("transaction not found", "transaction not found for " + line.rstrip("\n")
+                           + "\ntransaction info: " + str(transaction_info), file=tsv_file, lineno=record.lineno)
+            return action
         tx_to_id[key] += 1
+        action["tx"] = self.transaction_id(tx)
+
+        price_key = (isin, datetime_date, stock_cents, action["currency"])
+        if assets_acc != None:
+            prices = self.stock_prices(assets_acc.GetCommodity(), currency)
+            action["price_exists"] = (datetime_date, Fraction(stock_cents, 100)) in prices
+        if self.dry_run:
+            action["price_exists"] |= price_key in self.planned_prices
+            self.planned_prices.add(price_key)
+
+        # the splits are compared for the whole batch in reconcile_portfolio_actions
+        action["op"] = "reconcile"
+        action["reconcile"] = (tx, giro_acc, fee_acc, assets_acc, currency, stock_count, total_stock_cents)
+        return action
+
+    def split_values(self, transaction):
+        """Returns {account full name: (value num, value denom, amount num, amount denom)} for the splits of transaction.
+        Like find_split_by_account, the first split of an account wins.
+        """
+        values = {}
+        for split in transaction.GetSplitList():
+            name = split.GetAccount().get_full_name()
+            if name in values:
+                continue
+            value = split.GetValue()
+            amount = split.GetAmount()
+            values[name] = (value.num(), value.denom(), amount.num(), amount.denom())
+        return values
+
+    def reconcile_portfolio_actions(self, actions):
+        """Completes the planned portfolio actions of a batch with the splits that differ from the book.
+        The split values of every transaction are read once and compared as integers, instead of
+        going through the bindings for every split of every line.
+        """
+        # earlier lines might already change a split: in dry-run mode for the whole plan, otherwise for the batch
+        planned_splits = self.planned_splits if self.dry_run else {}
+        tx_values = {}
+        tx_currencies = {}
+        account_names = {}
+
+        def account_name(account):
+            if account == None:
+                return None
+            if id(account) not in account_names:
+                account_names[id(account)] = account.get_full_name()
+            return account_names[id(account)]
 
-        self.goc_stock_price(stock_commodity, stock_cents, datetime_date)
-
-        # find split with the spent money
-        sp_giro = self.find_split_by_account(tx, giro_acc)
-
-        if not sp_giro:
-            raise "ERROR: split not found"
+        for action in actions:
+            if action["op"] != "reconcile":
+                continue
+            try:
+                tx, giro_acc, fee_acc, assets_acc, currency, stock_count, total_stock_cents = action.pop("reconcile")
+                values = tx_values.get(action["tx"])
+                if values == None:
+                    values = tx_values[action["tx"]] = self.split_values(tx)
+                    tx_currencies[action["tx"]] = tx.GetCurrency() or currency
+                tx_currency = tx_currencies[action["tx"]]
+                fraction = tx_currency.get_fraction()
+                datetime_date = datetime.fromisoformat(action["date"])
+
+                # find split with the spent money
+                giro_values = values.get(account_name(giro_acc))
+                if giro_values == None:
+                    raise Exception("ERROR: split not found")
+
+                splits = []
+                # broker_expenses
+                total_cents = giro_values[0]
+                # the split values are in the currency of the transaction
+                total_stock_cents = self.convert(total_stock_cents, currency, tx_currency, datetime_date)
+                expenses_cents = abs(abs(total_cents) - abs(total_stock_cents))
+                if expenses_cents > 0:
+                    fee_currency = self.account_currency(fee_acc)
+                    fee_amount = self.convert(expenses_cents, tx_currency, fee_currency, datetime_date)
+                    splits.append((account_name(fee_acc), None, (expenses_cents, fraction),
+                                   (fee_amount, fee_currency.get_fraction())))
+                splits.append((account_name(assets_acc), action["isin"], (total_stock_cents, fraction), (int(stock_count*1000000), 1000000)))
+                # the trading account is created by execute_portfolio_action if it does not exist yet
+                splits.append((self.trading_account_name(tx_currency), None, (total_stock_cents, fraction),
+                               (total_stock_cents, fraction)))
+
+                for name, split_isin, value, amount in splits:
+                    key = (action["tx"], split_isin or name)
+                    planned = planned_splits.get(key)
+                    if planned:
+                        changed = planned != (value, amount)
+                    else:
+                        existing = values.get(name) if name != None else None
+                        changed = (existing == None
+                                   or existing[0] * value[1] != value[0] * existing[1]
+                                   or existing[2] * amount[1] != amount[0] * existing[3])
+                    if changed:
+                        action["splits"].append({"account": None if split_isin else name, "isin": split_isin,
+                                                 "value": value, "amount": amount})
+                        planned_splits[key] = (value, amount)
+                action["op"] = "update" if action["splits"] else "noop"
+            except Exception as e:
+                raise records.line_error(action["file"], action["lineno"], action["line"]) from e
+
+    def execute_portfolio_action(self, action):
+        if action["op"] not in ("update", "noop"):
+            return
+        with self.profiler.phase("account resolution"):
+            invest_root = self.find_account(action["invest_root"])
+            assets_acc = self.goc_stock_account(invest_root, action["isin"], ACCT_TYPE_STOCK)
+        if not action["price_exists"]:
+            with self.profiler.phase("prices"):
+                self.goc_stock_price(assets_acc.GetCommodity(), action["stock_cents"], datetime.fromisoformat(action["date"]),
+                                     self.currency(action["currency"]))
+        if action["op"] == "noop":
+            return
 
+        tx = self.lookup_transaction(action["tx"])
         updated = False
+        self.bulk_edit.hold_transaction(tx)
         tx.BeginEdit()
-
-        # broker_expenses
-        total_cents = sp_giro.GetValue().num()
-        expenses_cents = abs(abs(total_cents) - abs(total_stock_cents))
-        if expenses_cents > 0:
-            _, isChanged = self.goc_EUR_split(tx, fee_acc, expenses_cents)
+        stock_split = None
+        stock_split_created = False
+        for sp in action["splits"]:
+            if sp["isin"]:
+                account = assets_acc
+                stock_split_created = self.find_split_by_account(tx, assets_acc) == None
+            elif sp["account"].startswith("Trading.CURRENCY."):
+                account = self.trading_account(self.currency(sp["account"].split(".")[-1]))
+            else:
+                account = self.find_account(sp["account"])
+            with self.profiler.phase("split upserts"):
+                split, isChanged = self.goc_split(tx, account, GncNumeric(*sp["value"]), GncNumeric(*sp["amount"]))
             updated |= isChanged
-
-        _, isChanged = self.goc_stock_split(tx, assets_acc, stock_count, total_stock_cents)
-        updated |= isChanged
-        value = GncNumeric(total_stock_cents, self.currency_EUR.get_fraction())
-        _, isChanged = self.goc_split(tx, currency_acc, value, value)
-        updated |= isChanged
-
+            if sp["isin"] and isChanged:
+                stock_split = split
         tx.CommitEdit()
+        if self.assign_lots and stock_split != None:
+            self.assign_lot(assets_acc, stock_split, stock_split_created)
 
-        if updated:
-            print()
-            print("  imported " + line)
-            self.print_transaction(tx)
-
-
+        if not updated:
+            return
+        self.log.info("update", lambda: ["  imported " + action["line"].rstrip("\n")] + self.transaction_lines(tx),
+                      file=action["file"], lineno=action["lineno"], isin=action["isin"], date=action["date"])
+
+
+
+
+def statement_unchanged(snap, tsv_file, account):
+    """Returns true if importing the statement tsv_file into account would not change the book,
+    according to the snapshot snap. Mirrors the exact matching of plan_statement_record.
+    """
+    for record in records.parse(tsv_file, records.StatementRecord):
+        if record.datetime_date is None:
+            continue
+        if record.currency and not snap.currency.endswith(":" + record.currency.upper()):
+            # rows in other currencies are left to plan_statement_record
+            return False
+        desc_hash = snapshot.description_hash(record.description)
+        # cents of EUR, as in plan_statement_record
+        value = (record.cents, 100)
+        candidates = [split for split in snap.lookup(account, record.datetime_date.date().toordinal())
+                      if split.description_hash == desc_hash
+                      and (split.num == "" or split.num == record.num)
+                      and split.value[0] * value[1] == value[0] * split.value[1]]
+        if len(candidates) != 1:
+            return False
+        split = candidates[0]
+        if split.num != record.num or split.currency != snap.currency:
+            return False
+        if split.amount[0] * value[1] != value[0] * split.amount[1]:
+            return False
+    return True
+
+
+def book_side_file(url, suffix):
+    """Returns the path of the book file of the --gnucash url with suffix appended,
+    or None if there is no url or it does not refer to a file
+    """
+    path = snapshot.book_file(url) if url else None
+    if path == None:
+        return None
+    return path + suffix
+
+
+def input_files(files):
+    """Returns the list of files given as comma separated list, expanding @<manifest> entries"""
+    result = []
+    for name in files.split(","):
+        if name.startswith("@"):
+            with open(name[1:]) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        result.append(line)
+        elif name:
+            result.append(name)
+    return result
 
 
 if __name__ == '__main__':
     args = docopt(__doc__)
-    print("Args: " + str(args))
+    output = log.Log(args["--log-level"], args["--log-format"])
+    output.debug("args", "Args: " + str(args))
+
+    if args["report"]:
+        output.flush()
+        # numpy is only needed for export and report
+        import report
+        tables = report.load(args["<export_file>"])
+        for name, function in report.reports.items():
+            if args[name]:
+                function(tables, output)
+        output.flush()
+        sys.exit(0)
+
+    snapshot_path = None
+    if args["--snapshot"]:
+        snapshot_path = book_side_file(args["--gnucash"], ".snapshot")
+    if snapshot_path and args["statement"] and not args["--heuristic"]:
+        snap = snapshot.Snapshot.open(snapshot_path, snapshot.book_file(args["--gnucash"]))
+        if snap:
+            account = args["<checking_root>"] or "Assets.Current Assets.Checking Account"
+            unchanged = all(statement_unchanged(snap, tsv_file, account) for tsv_file in input_files(args["<tsv_file>"]))
+            snap.close()
+            if unchanged:
+                output.info("snapshot", "Nothing to import according to " + snapshot_path + ", the book was not opened")
+                output.flush()
+                sys.exit(0)
+
+    if args["gains"] and args["--lots"] and args["--plan"]:
+        sys.exit("ERROR: gains --lots assigns the lots in the book directly, it can not be written to a --plan")
+
+    state_path = None
+    if args["--incremental"]:
+        state_path = args["--state"] or book_side_file(args["--gnucash"], ".import-state.sqlite")
+        if state_path == None:
+            sys.exit("ERROR: --incremental needs --state <file> or a --gnucash book file")
 
     session = None
+    cs = None
     try:
         if args["--gnucash"]:
             session = Session(args["--gnucash"])
             book = session.book
             root = book.get_root_account()
-        cs = CashScript(session, args)
+        cs = CashScript(session, args, output)
+        if cs.profiler.enabled:
+            cs.profiler.instrument([Account, Split, Transaction, GncNumeric, GncCommodity, GncPrice,
+                                    getattr(gc, "GncCommodityTable", None), getattr(gc, "GncPriceDB", None)])
+        if args["--incremental"]:
+            cs.import_state = state.ImportState(state_path)
+        if args["--plan"]:
+            cs.plan_file = open(args["--plan"], "w")
 
         def find_acc(args, key, default):
             acc_path = args[key] or default
@@ -577,28 +1917,82 @@ if __name__ == '__main__':
         if args["portfolio"]:
             checking_root = find_checking(args)
             invest_root = find_acc(args, "<invest_root>", "Assets.Investments")
-            cs.read_portfolio_transactions(args["<tsv_file>"], checking_root, invest_root)
+            tsv_files = input_files(args["<tsv_file>"])
+            cs.prepare_portfolio_accounts(tsv_files, invest_root)
+            for tsv_file in tsv_files:
+                output.info("file", "Importing " + tsv_file, file=tsv_file)
+                cs.read_portfolio_transactions(tsv_file, checking_root, invest_root)
 
         if args["create-portfolio-account"]:
             invest_root = find_acc(args, "<invest_root>", "Assets.Investments")
             isins = args["<isins>"]
-            for isin in isins.split(","):
-                assets_acc = cs.goc_stock_account(invest_root, isin, ACCT_TYPE_STOCK)
+            cs.create_stock_accounts(invest_root, isins.split(","))
 
         if args["statement"]:
             checking_root = find_checking(args)
-            cs.read_statement_transactions(args["<tsv_file>"], checking_root)
+            for tsv_file in input_files(args["<tsv_file>"]):
+                output.info("file", "Importing " + tsv_file, file=tsv_file)
+                cs.read_statement_transactions(tsv_file, checking_root)
 
         if args["ofx"]:
             checking_root = find_checking(args)
-            cs.read_ofx_transactions(args["<ofx_file>"])
+            for ofx_file in input_files(args["<ofx_file>"]):
+                output.info("file", "Importing " + ofx_file, file=ofx_file)
+                cs.read_ofx_transactions(ofx_file, checking_root)
+
+        if args["apply-plan"]:
+            cs.apply_plan(args["<plan_file>"])
+
+        if args["prices"]:
+            invest_root = find_acc(args, "<invest_root>", "Assets.Investments")
+            jobs = int(args["--fetch-jobs"])
+            # without a book file the quotes are only cached for this run
+            cache_path = args["--quote-cache"] or book_side_file(args["--gnucash"], ".quotes.json")
+            cache = quotes.QuoteCache(cache_path, int(args["--quote-ttl"]))
+            cs.update_prices(invest_root, quotes.fetcher(args["--quote-source"], jobs), cache, jobs)
+
+        if args["gains"]:
+            cs.print_gains(find_acc(args, "<invest_root>", "Assets.Investments"))
+
+        if args["export"]:
+            output.flush()
+            import report
+            with cs.profiler.phase("export"):
+                report.export(args["<export_file>"], root, cs.commod_tab, cs.price_db, cs.split_fmt, output)
 
+        cs.print_plan_summary()
+        cs.stock_catalog.report_missing(output)
 
         # print(dir(root))
         # cs.print_accounts(root)
 
-        if session: session.save()
+        if session and not cs.dry_run and not args["export"]:
+            with cs.profiler.phase("save"):
+                session.save()
+            if cs.import_state:
+                cs.import_state.commit()
+        if session and args["--snapshot"]:
+            with cs.profiler.phase("snapshot"):
+                splits = cs.snapshot_splits()
+            # ending the session releases the lock of SQL backends, which changes the book file,
+            # so the snapshot is written afterwards
+            session.end()
+            session = None
+            # the book file may have been created by saving
+            snapshot_path = book_side_file(args["--gnucash"], ".snapshot")
+            if snapshot_path:
+                with cs.profiler.phase("snapshot"):
+                    snapshot.write(snapshot_path, snapshot.book_file(args["--gnucash"]),
+                                   cs.currency_EUR.get_unique_name(), splits)
+
+        output.summary()
+        cs.profiler.print_summary(output)
+        if args["--profile-out"]:
+            cs.profiler.write(args["--profile-out"])
     finally:
+        output.flush()
+        if cs and cs.plan_file: cs.plan_file.close()
+        if cs and cs.import_state: cs.import_state.close()
         if session: session.end()
 
 
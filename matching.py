@@ -0,0 +1,115 @@
+"""Matching of statement lines without reliable descriptions, used with --heuristic, and of the
+portfolio rows of a checking account in a worker process, see match_portfolio_partition.
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from functools import lru_cache
+
+
+# marks a line that has several equally good candidates
+AMBIGUOUS = object()
+
+
+@lru_cache(maxsize=65536)
+def tokens(description):
+    """Returns the set of lower case words of description"""
+    return frozenset(re.findall(r"\w+", description.lower()))
+
+
+def similarity(a, b):
+    """Returns the Jaccard similarity of two sets of tokens"""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class HeuristicMatcher:
+
+    def __init__(self, tolerance_days=0):
+        self.tolerance_days = tolerance_days
+        # a range of 2 * tolerance + 1 days touches at most three buckets
+        self.bucket_days = tolerance_days + 1
+        self.buckets = defaultdict(list)
+        self.candidates = []
+        self.lines = []
+
+    def add_candidate(self, key, date, value, description, num):
+        """Adds an existing transaction. value must be comparable with the values of the lines."""
+        candidate = (key, date.toordinal(), tokens(description), num)
+        self.candidates.append(candidate)
+        self.buckets[(value, date.toordinal() // self.bucket_days)].append(candidate)
+
+    def add_line(self, key, date, value, description, num):
+        self.lines.append((key, date.toordinal(), value, tokens(description), num))
+
+    def scored(self, line):
+        """Yields (score, candidate key) for the candidates of line"""
+        key, day, value, line_tokens, num = line
+        first = (day - self.tolerance_days) // self.bucket_days
+        last = (day + self.tolerance_days) // self.bucket_days
+        for bucket in range(first, last + 1):
+            for candidate_key, candidate_day, candidate_tokens, candidate_num in self.buckets.get((value, bucket), ()):
+                distance = abs(candidate_day - day)
+                if distance > self.tolerance_days:
+                    continue
+                # as in find_transaction, a transaction without number matches any number
+                if candidate_num != "" and candidate_num != num:
+                    continue
+                score = (similarity(line_tokens, candidate_tokens), -distance, candidate_num == num)
+                yield score, candidate_key
+
+    def assign(self):
+        """Returns {line key: candidate key} for the lines with a match.
+        Lines whose best remaining candidates are equally good are mapped to AMBIGUOUS.
+        """
+        edges = []
+        for order, line in enumerate(self.lines):
+            for score, candidate_key in self.scored(line):
+                edges.append((score, order, candidate_key))
+        # best scores first, earlier lines win ties
+        edges.sort(key=lambda edge: (edge[0], -edge[1]), reverse=True)
+
+        assigned = {}
+        used = set()
+        for score, order, candidate_key in edges:
+            if order in assigned or candidate_key in used:
+                continue
+            assigned[order] = (score, candidate_key)
+            used.add(candidate_key)
+
+        # a line is ambiguous if a candidate as good as its own was left over
+        best_unused = {}
+        for score, order, candidate_key in edges:
+            if candidate_key not in used and order not in best_unused:
+                best_unused[order] = score
+        result = {}
+        for order, (score, candidate_key) in assigned.items():
+            line_key = self.lines[order][0]
+            result[line_key] = AMBIGUOUS if best_unused.get(order) == score else candidate_key
+        return result
+
+
+# distributions are booked without a purchase of shares
+distribution_words = ("Erträgnisausschüttung", "Dividendenzahlung")
+
+
+def match_portfolio_partition(partition):
+    """Matches the portfolio rows of one checking account against a snapshot of its splits.
+    partition is (days, rows): days maps date ordinals to [(description, transaction index)],
+    rows are (line number, first date ordinal, last date ordinal, ISIN).
+    Returns [(line number, transaction indices)] with the candidates of the latest day that has any.
+    """
+    days, rows = partition
+    dates = sorted(days)
+    result = []
+    for lineno, first, last, isin in rows:
+        candidates = []
+        for i in range(bisect_right(dates, last) - 1, bisect_left(dates, first) - 1, -1):
+            candidates = [tx for description, tx in days[dates[i]]
+                          if isin in description and not any(word in description for word in distribution_words)]
+            if candidates:
+                break
+        result.append((lineno, candidates))
+    return result
@@ -0,0 +1,179 @@
+"""Stock quotes for the prices subcommand, fetched concurrently and cached in a JSON file."""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+import bs4
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Quote:
+    __slots__ = ("isin", "date", "cents", "fetched")
+
+    def __init__(self, isin, date, cents, fetched=None):
+        self.isin = isin
+        self.date = date
+        self.cents = cents
+        self.fetched = time.time() if fetched is None else fetched
+
+
+def to_cents(price):
+    """Returns the price given as number or string with a decimal point or comma in cents"""
+    price = Decimal(str(price).replace(",", "."))
+    return int((price * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_date(date):
+    """Returns the day of an ISO date or date time as datetime"""
+    return datetime.fromisoformat(str(date)[:10])
+
+
+def quote_from_json(isin, document):
+    return Quote(isin, to_date(document["date"]), to_cents(document["price"]))
+
+
+class DirectoryFetcher:
+    """Reads quotes from the files <directory>/<isin>.json"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def fetch(self, isin):
+        with open(os.path.join(self.directory, isin + ".json")) as f:
+            return quote_from_json(isin, json.load(f))
+
+
+class UrlFetcher:
+    """Fetches quotes as JSON documents from a URL template with an {isin} placeholder"""
+
+    def __init__(self, template, session):
+        self.template = template
+        self.session = session
+
+    def fetch(self, isin):
+        response = self.session.get(self.template.format(isin=isin), timeout=30)
+        response.raise_for_status()
+        return quote_from_json(isin, response.json())
+
+
+class OnvistaFetcher:
+    """Fetches the last price from the onvista.de page of an ISIN, e.g. https://www.onvista.de/LU1737652583"""
+
+    url = "https://www.onvista.de/"
+
+    def __init__(self, session):
+        self.session = session
+
+    def fetch(self, isin):
+        response = self.session.get(self.url + isin, timeout=30)
+        response.raise_for_status()
+        soup = bs4.BeautifulSoup(response.text, "html.parser")
+        data = soup.find("script", id="__NEXT_DATA__")
+        if data == None:
+            raise ValueError("no quote data on " + response.url)
+        quote = self.find_quote(json.loads(data.string))
+        if quote == None:
+            raise ValueError("no quote on " + response.url)
+        return Quote(isin, to_date(quote["datetimeLast"]), to_cents(quote["last"]))
+
+    def find_quote(self, node):
+        """Returns the first object with a last price in EUR in the page data"""
+        if isinstance(node, dict):
+            if "last" in node and "datetimeLast" in node and node.get("isoCurrency", "EUR") == "EUR":
+                return node
+            node = list(node.values())
+        if isinstance(node, list):
+            for child in node:
+                quote = self.find_quote(child)
+                if quote != None:
+                    return quote
+        return None
+
+
+def http_session(jobs):
+    session = requests.Session()
+    # one pooled connection per worker thread
+    adapter = HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetcher(source, jobs=1):
+    """Returns the fetcher of a --quote-source"""
+    if source.startswith("dir:"):
+        return DirectoryFetcher(source[len("dir:"):])
+    if source.startswith("url:"):
+        return UrlFetcher(source[len("url:"):], http_session(jobs))
+    if source == "onvista":
+        return OnvistaFetcher(http_session(jobs))
+    raise ValueError("unknown quote source " + str(source))
+
+
+class QuoteCache:
+    """Quotes by ISIN, stored as JSON in path"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.quotes = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for isin, entry in json.load(f).items():
+                    self.quotes[isin] = Quote(isin, to_date(entry["date"]), entry["cents"], entry["fetched"])
+
+    def get(self, isin):
+        """Returns the cached quote of isin if it is younger than the TTL"""
+        quote = self.quotes.get(isin)
+        if quote == None or time.time() - quote.fetched > self.ttl:
+            return None
+        return quote
+
+    def put(self, quote):
+        self.quotes[quote.isin] = quote
+
+    def save(self):
+        if not self.path:
+            return
+        entries = {isin: {"date": quote.date.date().isoformat(), "cents": quote.cents, "fetched": quote.fetched}
+                   for isin, quote in sorted(self.quotes.items())}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def fetch_all(fetcher, isins, jobs):
+    """Fetches the quotes of isins with up to jobs threads. Returns {isin: quote or exception}."""
+    def fetch(isin):
+        try:
+            return fetcher.fetch(isin)
+        except Exception as e:
+            return e
+
+    isins = list(isins)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        return dict(zip(isins, pool.map(fetch, isins)))
+
+
+def quotes(isins, fetcher, cache, jobs):
+    """Returns {isin: quote or exception}, the quotes that are not cached are fetched concurrently"""
+    result = {}
+    missing = []
+    for isin in isins:
+        quote = cache.get(isin)
+        if quote != None:
+            result[isin] = quote
+        else:
+            missing.append(isin)
+    for isin, quote in fetch_all(fetcher, missing, jobs).items():
+        if isinstance(quote, Quote):
+            cache.put(quote)
+        result[isin] = quote
+    cache.save()
+    return result
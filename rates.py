@@ -0,0 +1,53 @@
+"""Exchange rates between currencies, looked up at the nearest date."""
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from fractions import Fraction
+
+
+class RateTable:
+
+    def __init__(self):
+        self.added = defaultdict(list)
+        # (from, to) -> (sorted date ordinals, rates)
+        self.series = {}
+
+    def add(self, source, target, date, rate):
+        """Adds the rate of one unit of source in target on date"""
+        self.added[(source, target)].append((date.toordinal(), Fraction(rate)))
+        self.series.pop((source, target), None)
+
+    def pair(self, source, target):
+        """Returns (ordinals, rates) of a pair, sorted on first use"""
+        series = self.series.get((source, target))
+        if series == None:
+            entries = sorted(self.added.get((source, target), ()))
+            series = self.series[(source, target)] = (array("l", [day for day, _ in entries]),
+                                                      [rate for _, rate in entries])
+        return series
+
+    def nearest(self, source, target, day):
+        days, rates = self.pair(source, target)
+        if not days:
+            return None
+        i = bisect_left(days, day)
+        if i == len(days) or (i > 0 and day - days[i - 1] <= days[i] - day):
+            i -= 1
+        return rates[i]
+
+    def rate(self, source, target, date):
+        """Returns the rate of one unit of source in target closest to date, or None"""
+        if source == target:
+            return Fraction(1)
+        day = date.toordinal()
+        rate = self.nearest(source, target, day)
+        if rate != None:
+            return rate
+        rate = self.nearest(target, source, day)
+        if rate:
+            return 1 / rate
+        return None
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.added.values())
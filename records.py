@@ -0,0 +1,187 @@
+"""Parsing of the statement and portfolio TSV exports into records, as a stream of generators."""
+
+import multiprocessing
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+from itertools import islice
+
+
+portfolio_ignored_infos = [
+    "Dividendenzahlung",
+    "Erträgnisausschüttung",
+    "Lagerstellenwechsel",
+    "WP-Ausbuchung",
+    "Spin Off in",
+    ]
+
+
+def restore_record(record_type, values):
+    record = record_type.__new__(record_type)
+    for name, value in zip(record_type.__slots__, values):
+        setattr(record, name, value)
+    return record
+
+
+class Record:
+    __slots__ = ()
+
+    def __reduce__(self):
+        # records travel between processes with --jobs, pickle them as a plain tuple of their fields
+        return restore_record, (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
+
+class StatementRecord(Record):
+    __slots__ = ("lineno", "line", "date", "datetime_date", "description", "num", "currency", "value", "cents")
+
+    def __init__(self, lineno, line, row):
+        self.lineno = lineno
+        self.line = line
+        self.date = row[0]
+        self.description = row[4]
+        self.num = row[5]
+        # rows without an ISO 4217 code are in the currency of the account
+        self.currency = row[6].strip()
+        self.value = row[7]
+        self.cents = int(self.value.replace(",",""))
+
+        try:
+            self.datetime_date = datetime.fromisoformat(self.date)
+        except ValueError:
+            self.datetime_date = None
+
+
+class PortfolioRecord(Record):
+    __slots__ = ("lineno", "line", "acc_number", "entry_date", "valuta_date", "isin", "description",
+                 "nominal", "transaction_info", "price", "depot",
+                 "stock_count", "stock_cents", "total_stock_cents", "datetime_date", "datetime_valuta")
+
+    def __init__(self, lineno, line, row):
+        self.lineno = lineno
+        self.line = line
+        self.acc_number = row[0]
+        self.entry_date = row[1]
+        self.valuta_date = row[2]
+        self.isin = row[3]
+        self.description = row[4]
+        self.nominal = row[5]
+        self.transaction_info = row[7]
+        self.price = row[9]
+        self.depot = row[10]
+
+        self.stock_count = Decimal(self.nominal.replace(",","."))
+        stock_price = Decimal(self.price.replace(",","."))
+        self.stock_cents = int(stock_price * 100)
+        self.total_stock_cents = int(self.stock_count * stock_price * 100)
+
+        # ignored rows may have no valid dates, filter_portfolio_records checks the others
+        try:
+            self.parse_dates()
+        except ValueError:
+            self.datetime_date = None
+            self.datetime_valuta = None
+
+    def parse_dates(self):
+        self.datetime_date = datetime.fromisoformat(self.entry_date)
+        self.datetime_valuta = datetime.fromisoformat(self.valuta_date)
+
+
+def line_error(path, lineno, line, context=""):
+    return RuntimeError("Problem in line " + str(lineno) + " of " + str(path) + context + ": " + line)
+
+
+def read_lines(path):
+    """Yields (line number, line) for every line of path that is not a comment"""
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if line.startswith("#"):
+                continue
+            yield i+1, line
+
+
+def parse_line(record_type, lineno, line):
+    return record_type(lineno, line, line.rstrip("\n").split("\t"))
+
+
+def parse(path, record_type, lines=None, jobs=1, chunk_size=1000):
+    """Yields a record of record_type for every line of path.
+    With more than one job the lines are parsed in a process pool, the records keep their order.
+    """
+    if lines is None:
+        lines = read_lines(path)
+    if jobs > 1:
+        yield from parse_parallel(path, record_type, lines, jobs, chunk_size)
+        return
+    for lineno, line in lines:
+        try:
+            yield parse_line(record_type, lineno, line)
+        except Exception as e:
+            raise line_error(path, lineno, line) from e
+
+
+def parse_chunk(record_type, chunk):
+    """Parses a list of (line number, line) in a worker process.
+    Returns (record, None) per line, or ((line number, line), exception) if the line could not be parsed.
+    """
+    result = []
+    for lineno, line in chunk:
+        try:
+            result.append((parse_line(record_type, lineno, line), None))
+        except Exception as e:
+            result.append(((lineno, line), e))
+    return result
+
+
+def parse_parallel(path, record_type, lines, jobs, chunk_size):
+    with multiprocessing.Pool(jobs) as pool:
+        # only a few chunks are in flight, so that large files are not read into memory at once
+        pending = deque()
+        chunks = batches(lines, chunk_size)
+        while True:
+            for chunk in islice(chunks, 2*jobs - len(pending)):
+                pending.append(pool.apply_async(parse_chunk, (record_type, chunk)))
+            if not pending:
+                return
+            for record, error in pending.popleft().get():
+                if error is not None:
+                    lineno, line = record
+                    raise line_error(path, lineno, line) from error
+                yield record
+
+
+def filter_statement_records(records, log):
+    for record in records:
+        if record.datetime_date is None:
+            log.warning("invalid date", "Ignoring record because of erroneous date: " + str(record.date),
+                        lineno=record.lineno)
+            continue
+        yield record
+
+
+def portfolio_ignored(record):
+    if record.total_stock_cents == 0:
+        return True
+    return any(info in record.transaction_info for info in portfolio_ignored_infos)
+
+
+def filter_portfolio_records(records, log, path=None):
+    for record in records:
+        if portfolio_ignored(record):
+            log.warning("ignored row", "ignoring " + str(record.line.rstrip("\n")), lineno=record.lineno)
+            continue
+        if record.datetime_date is None:
+            try:
+                record.parse_dates()
+            except ValueError as e:
+                raise line_error(path, record.lineno, record.line) from e
+        yield record
+
+
+def batches(records, size):
+    """Yields lists of up to size records"""
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,241 @@
+"""Columnar export of a book as NumPy arrays and the reports computed from it."""
+
+from collections import defaultdict
+from fractions import Fraction
+
+import numpy as np
+
+
+currency_namespaces = ("ISO4217", "CURRENCY")
+
+
+class Columns:
+    """Columns of a table, filled row by row"""
+
+    def __init__(self, *names):
+        self.columns = {name: [] for name in names}
+        self.rows = 0
+
+    def append(self, **values):
+        for name, value in values.items():
+            self.columns.setdefault(name, []).append(value)
+        self.rows += 1
+        return self.rows - 1
+
+    def numeric(self, values, name, numeric):
+        values[name + "_num"] = numeric.num()
+        values[name + "_denom"] = numeric.denom()
+
+    def arrays(self, table):
+        result = {}
+        for name, values in self.columns.items():
+            if name in ("date", "time"):
+                array = np.array(values, dtype="datetime64[s]")
+            elif not values or isinstance(values[0], int):
+                array = np.array(values, dtype=np.int64)
+            else:
+                array = np.array(values, dtype=str)
+            result[table + "." + name] = array
+        return result
+
+
+def export(path, root, commodity_table, price_db, split_fmt, log):
+    """Writes the accounts below root with their splits, the transactions of those splits
+    and the prices of all commodities to the .npz file path
+    """
+    commodities = Columns("unique_name", "namespace", "cusip", "fullname", "fraction")
+    accounts = Columns("name", "parent", "type", "commodity")
+    transactions = Columns("guid", "date", "num", "description", "currency")
+    splits = Columns("tx", "account", "value_num", "value_denom", "amount_num", "amount_denom")
+    prices = Columns("commodity", "currency", "time", "value_num", "value_denom")
+    commodity_index = {}
+    tx_index = {}
+
+    def commodity(c):
+        if c == None:
+            return -1
+        name = c.get_unique_name()
+        if name not in commodity_index:
+            commodity_index[name] = commodities.append(
+                unique_name=name, namespace=c.get_namespace(), cusip=c.get_cusip() or "",
+                fullname=c.get_fullname(), fraction=c.get_fraction())
+        return commodity_index[name]
+
+    stack = [(root, -1)]
+    while stack:
+        account, parent = stack.pop()
+        index = accounts.append(name=account.get_full_name(), parent=parent, type=account.GetType(),
+                                commodity=commodity(account.GetCommodity()))
+        for child in reversed(account.get_children()):
+            stack.append((child, index))
+
+        for split in account.GetSplitList():
+            tx = split.GetParent()
+            guid = tx.GetGUID().to_string()
+            if guid not in tx_index:
+                tx_index[guid] = transactions.append(
+                    guid=guid, date=tx.GetDate(), num=tx.GetNum(), description=tx.GetDescription(),
+                    currency=commodity(tx.GetCurrency()))
+            values = {"tx": tx_index[guid], "account": index}
+            for _, name, getter in split_fmt:
+                if name == "account":
+                    continue
+                value = getter(split)
+                if hasattr(value, "denom"):
+                    splits.numeric(values, name, value)
+                else:
+                    values[name] = str(value)
+            splits.append(**values)
+
+    for namespace in commodity_table.get_namespaces():
+        for c in commodity_table.get_commodities(namespace):
+            for price in price_db.get_prices(c, None):
+                values = {"commodity": commodity(price.get_commodity()),
+                          "currency": commodity(price.get_currency()), "time": price.get_time64()}
+                prices.numeric(values, "value", price.get_value())
+                prices.append(**values)
+
+    arrays = {}
+    for table, columns in (("commodities", commodities), ("accounts", accounts), ("transactions", transactions),
+                           ("splits", splits), ("prices", prices)):
+        arrays.update(columns.arrays(table))
+    np.savez_compressed(path, **arrays)
+    log.info("export", "exported " + str(accounts.rows) + " accounts, " + str(transactions.rows) + " transactions, "
+             + str(splits.rows) + " splits and " + str(prices.rows) + " prices to " + str(path),
+             file=path, accounts=accounts.rows, transactions=transactions.rows, splits=splits.rows, prices=prices.rows)
+
+
+def load(path):
+    """Returns {table: {column: array}} of an export"""
+    tables = defaultdict(dict)
+    with np.load(path) as data:
+        for key in data.files:
+            table, column = key.split(".", 1)
+            tables[table][column] = data[key]
+    return tables
+
+
+def sums(groups, num, denom, size):
+    """Returns the exact sums of num/denom per group index as a list of size Fractions.
+    The numerators are added once per distinct denominator, as Python integers: with the
+    denominator of 10^6 of the share amounts, int64 sums of large positions can overflow.
+    """
+    totals = [Fraction(0)] * size
+    for d in np.unique(denom):
+        mask = denom == d
+        group_sums = np.zeros(size, dtype=object)
+        np.add.at(group_sums, groups[mask], num[mask].astype(object))
+        for group in np.flatnonzero(group_sums):
+            totals[group] += Fraction(int(group_sums[group]), int(d))
+    return totals
+
+
+def decimals(fraction):
+    """Returns the number of decimal places of a commodity fraction like 100"""
+    return max(len(str(int(fraction))) - 1, 0)
+
+
+def is_stock(commodities, index):
+    return index >= 0 and commodities["namespace"][index] not in currency_namespaces
+
+
+def balances(tables, log):
+    accounts, splits, commodities = tables["accounts"], tables["splits"], tables["commodities"]
+    size = len(accounts["name"])
+    totals = sums(splits["account"], splits["amount_num"], splits["amount_denom"], size)
+    counts = np.bincount(splits["account"], minlength=size)
+    log.info("header", "{:<80}{:>20}  {}".format("account", "balance", "commodity"))
+    for index in np.argsort(accounts["name"]):
+        if counts[index] == 0:
+            continue
+        c = accounts["commodity"][index]
+        log.info("balance", "{:<80}{:>20.{}f}  {}".format(accounts["name"][index], float(totals[index]),
+                                                         decimals(commodities["fraction"][c]), commodities["unique_name"][c]),
+                 account=accounts["name"][index], balance=float(totals[index]), commodity=commodities["unique_name"][c])
+
+
+def latest_prices(tables):
+    """Returns {commodity index: (time, price)} of the latest price of every commodity.
+    Of the prices with the same time, the last one of the price database wins.
+    """
+    prices = tables["prices"]
+    latest = {}
+    for i in np.argsort(prices["time"], kind="stable"):
+        latest[int(prices["commodity"][i])] = (prices["time"][i],
+                                               Fraction(int(prices["value_num"][i]), int(prices["value_denom"][i])))
+    return latest
+
+
+def holdings(tables, log):
+    accounts, splits, commodities = tables["accounts"], tables["splits"], tables["commodities"]
+    size = len(accounts["name"])
+    shares = sums(splits["account"], splits["amount_num"], splits["amount_denom"], size)
+    invested = sums(splits["account"], splits["value_num"], splits["value_denom"], size)
+    latest = latest_prices(tables)
+
+    by_isin = defaultdict(lambda: [Fraction(0), Fraction(0), -1])
+    for index in range(size):
+        c = int(accounts["commodity"][index])
+        if not is_stock(commodities, c) or shares[index] == 0:
+            continue
+        holding = by_isin[commodities["cusip"][c] or commodities["unique_name"][c]]
+        holding[0] += shares[index]
+        holding[1] += invested[index]
+        holding[2] = c
+
+    log.info("header", "{:<16}{:<40}{:>16}{:>14}{:>14}{:>14}".format("isin", "name", "shares", "invested", "price", "value"))
+    for isin, (count, cost, c) in sorted(by_isin.items()):
+        price = latest.get(c)
+        price_text = value_text = ""
+        if price:
+            price_text = "{:.2f}".format(float(price[1]))
+            value_text = "{:.2f}".format(float(price[1] * count))
+        log.info("holding", "{:<16}{:<40}{:>16.6f}{:>14.2f}{:>14}{:>14}".format(
+                 isin, commodities["fullname"][c][:39], float(count), float(cost), price_text, value_text),
+                 isin=isin, shares=float(count), invested=float(cost), price=price_text, value=value_text)
+
+
+def cost_basis(tables, log):
+    """Prints the cost basis of the remaining shares and the realized gains with average costs"""
+    accounts, splits, commodities = tables["accounts"], tables["splits"], tables["commodities"]
+    stock = np.array([is_stock(commodities, int(c)) for c in accounts["commodity"]], dtype=bool)
+    rows = np.flatnonzero(stock[splits["account"]])
+    dates = tables["transactions"]["date"][splits["tx"][rows]]
+    rows = rows[np.lexsort((dates, splits["account"][rows]))]
+
+    # per account: shares, cost, proceeds, realized gain
+    results = defaultdict(lambda: [Fraction(0)] * 4)
+    for account, amount_num, amount_denom, value_num, value_denom in zip(
+            splits["account"][rows].tolist(), splits["amount_num"][rows].tolist(),
+            splits["amount_denom"][rows].tolist(), splits["value_num"][rows].tolist(),
+            splits["value_denom"][rows].tolist()):
+        amount = Fraction(amount_num, amount_denom)
+        value = Fraction(value_num, value_denom)
+        result = results[account]
+        shares, cost, proceeds, realized = result
+        if amount > 0:
+            shares += amount
+            cost += value
+        elif amount < 0 and shares > 0:
+            basis = cost * min(-amount, shares) / shares
+            shares += amount
+            cost -= basis
+            proceeds -= value
+            realized += -value - basis
+        result[:] = [shares, cost, proceeds, realized]
+
+    log.info("header", "{:<16}{:<40}{:>16}{:>14}{:>14}{:>14}".format("isin", "name", "shares", "cost basis", "proceeds", "realized"))
+    for account in sorted(results, key=lambda account: accounts["name"][account]):
+        shares, cost, proceeds, realized = results[account]
+        c = accounts["commodity"][account]
+        isin = commodities["cusip"][c] or commodities["unique_name"][c]
+        log.info("cost basis", "{:<16}{:<40}{:>16.6f}{:>14.2f}{:>14.2f}{:>14.2f}".format(
+                 isin, commodities["fullname"][c][:39], float(shares), float(cost), float(proceeds), float(realized)),
+                 isin=isin, shares=float(shares), cost=float(cost), proceeds=float(proceeds), realized=float(realized))
+
+
+reports = {
+    "balances": balances,
+    "holdings": holdings,
+    "cost-basis": cost_basis,
+    }
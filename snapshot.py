@@ -0,0 +1,144 @@
+"""Memory-mapped snapshot of the splits of a book, enabled with --snapshot.
+It is ignored as soon as the modification time or the size of the book file change.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+
+magic = b"GCSNAP01"
+# magic, book mtime in ns, book size, accounts, records, offsets of the records and the strings,
+# default currency (string offset, length)
+header = struct.Struct("<8sqqIIQQIH")
+# account name (string offset, length), first record, number of records
+account_entry = struct.Struct("<IHII")
+# date ordinal, value num, value denom, amount num, amount denom, description hash,
+# num (string offset, length), currency (string offset, length), transaction GUID
+record = struct.Struct("<iqqqqQIHIH16s")
+
+SnapshotSplit = namedtuple("SnapshotSplit", "date value amount description_hash num currency tx")
+
+
+def book_file(url):
+    """Returns the path of the file of a book URL like sqlite3:///path or path, or None"""
+    for scheme in ("xml://", "sqlite3://", "file://"):
+        if url.startswith(scheme):
+            url = url[len(scheme):]
+    return url if os.path.isfile(url) else None
+
+
+def book_stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def description_hash(description):
+    return int.from_bytes(hashlib.blake2b(description.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def write(path, book_path, currency, splits):
+    """Writes the snapshot of splits, an iterable of (account name, date ordinal, (value num, denom),
+    (amount num, denom), description, num, currency, transaction GUID) for the book file book_path.
+    currency is the unique name of the default currency.
+    """
+    strings = bytearray()
+    string_offsets = {}
+
+    def string(text):
+        if text not in string_offsets:
+            data = text.encode("utf-8")
+            string_offsets[text] = (len(strings), len(data))
+            strings.extend(data)
+        return string_offsets[text]
+
+    splits = sorted(splits, key=lambda split: (split[0], split[1]))
+    accounts = []
+    records = bytearray()
+    for i, (account, date, value, amount, description, num, tx_currency, guid) in enumerate(splits):
+        if not accounts or accounts[-1][0] != account:
+            accounts.append([account, i, 0])
+        accounts[-1][2] += 1
+        records.extend(record.pack(date, value[0], value[1], amount[0], amount[1], description_hash(description),
+                                   *string(num), *string(tx_currency), bytes.fromhex(guid)))
+
+    table = bytearray()
+    for account, first, count in accounts:
+        table.extend(account_entry.pack(*string(account), first, count))
+
+    records_offset = header.size + len(table)
+    strings_offset = records_offset + len(records)
+    mtime, size = book_stamp(book_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header.pack(magic, mtime, size, len(accounts), len(splits), records_offset, strings_offset,
+                            *string(currency)))
+        f.write(table)
+        f.write(records)
+        f.write(strings)
+    # readers either see the old or the new snapshot
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (file_magic, self.mtime, self.size, n_accounts, self.records, self.records_offset, self.strings_offset,
+         currency_offset, currency_length) = header.unpack_from(self.mm, 0)
+        if file_magic != magic:
+            self.mm.close()
+            raise ValueError(str(path) + " is not a snapshot")
+        self.currency = self.string(currency_offset, currency_length)
+        self.accounts = {}
+        for i in range(n_accounts):
+            name_offset, name_length, first, count = account_entry.unpack_from(self.mm, header.size + i * account_entry.size)
+            self.accounts[self.string(name_offset, name_length)] = (first, count)
+
+    @classmethod
+    def open(cls, path, book_path):
+        """Returns the snapshot at path if it is up to date with the book file, None otherwise"""
+        if book_path == None or not os.path.isfile(path):
+            return None
+        try:
+            snapshot = cls(path)
+        except (ValueError, struct.error):
+            return None
+        if (snapshot.mtime, snapshot.size) != book_stamp(book_path):
+            snapshot.close()
+            return None
+        return snapshot
+
+    def string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.mm[start:start + length].decode("utf-8")
+
+    def date_at(self, i):
+        return struct.unpack_from("<i", self.mm, self.records_offset + i * record.size)[0]
+
+    def lookup(self, account, date):
+        """Returns the splits of account posted on date, given as ordinal"""
+        first, count = self.accounts.get(account, (0, 0))
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.date_at(mid) < date:
+                lo = mid + 1
+            else:
+                hi = mid
+        splits = []
+        for i in range(lo, first + count):
+            (day, value_num, value_denom, amount_num, amount_denom, desc_hash, num_offset, num_length,
+             currency_offset, currency_length, guid) = record.unpack_from(self.mm, self.records_offset + i * record.size)
+            if day != date:
+                break
+            splits.append(SnapshotSplit(day, (value_num, value_denom), (amount_num, amount_denom), desc_hash,
+                                        self.string(num_offset, num_length),
+                                        self.string(currency_offset, currency_length), guid.hex()))
+        return splits
+
+    def close(self):
+        self.mm.close()
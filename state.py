@@ -0,0 +1,47 @@
+"""Import state kept next to the book, enabled with --incremental.
+Rows are only committed after the book was saved, see commit().
+"""
+
+import hashlib
+import sqlite3
+from datetime import datetime
+
+
+class ImportState:
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS rows (
+            hash TEXT PRIMARY KEY, kind TEXT, account TEXT, op TEXT, tx TEXT, imported TEXT)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS watermarks (
+            kind TEXT, account TEXT, date TEXT, rows INTEGER, PRIMARY KEY (kind, account))""")
+
+    def row_hash(self, kind, account, line, occurrence):
+        """Returns the hash of a row. Identical lines of a file are told apart by their occurrence."""
+        content = "\0".join([kind, account, line.rstrip("\n"), str(occurrence)])
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def lookup(self, row_hash):
+        """Returns (op, transaction GUID) of an imported row, or None"""
+        return self.db.execute("SELECT op, tx FROM rows WHERE hash = ?", (row_hash,)).fetchone()
+
+    def record(self, row_hash, kind, account, op, tx, date):
+        self.db.execute("INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?, ?)",
+                        (row_hash, kind, account, op, tx, datetime.now().isoformat()))
+        self.db.execute("""INSERT INTO watermarks VALUES (?, ?, ?, 1)
+            ON CONFLICT (kind, account) DO UPDATE SET date = max(date, excluded.date), rows = rows + 1""",
+                        (kind, account, date))
+
+    def watermark(self, kind, account):
+        """Returns the latest date and the number of the rows imported for kind and account, or None"""
+        return self.db.execute("SELECT date, rows FROM watermarks WHERE kind = ? AND account = ?",
+                               (kind, account)).fetchone()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        # rows that were not committed belong to a book that was not saved
+        self.db.rollback()
+        self.db.close()
@@ -0,0 +1,156 @@
+"""Tests of the lot positions and their assignment with --lots, against the fake gnucash backend in bench/"""
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(root_dir, "bench"))
+
+from gnucash import Account, Session, Transaction, Split, GncNumeric
+
+import log
+import lots
+import main
+
+
+class PositionTest(unittest.TestCase):
+
+    def test_fifo(self):
+        position = lots.Position("fifo")
+        position.buy(10000000, 10000, "a")
+        position.buy(10000000, 20000, "b")
+        taken = position.sell(15000000, 45000)
+        self.assertEqual(taken, [("a", 10000000), ("b", 5000000)])
+        self.assertEqual(position.shares, 5000000)
+        self.assertEqual(position.cost, 10000)
+        self.assertEqual(position.realized, 45000 - 20000)
+
+    def test_average(self):
+        position = lots.Position("average")
+        position.buy(10000000, 10000, "a")
+        position.buy(10000000, 20000, "b")
+        position.sell(10000000, 30000)
+        self.assertEqual(position.cost, 15000)
+        self.assertEqual(position.realized, 15000)
+
+    def test_sale_exceeding_the_shares_held(self):
+        position = lots.Position("fifo")
+        position.buy(5000000, 5000, "a")
+        taken = position.sell(10000000, 30000)
+        self.assertEqual(taken, [("a", 5000000)])
+        self.assertEqual(position.shares, 0)
+        # only the proceeds of the shares held are realized
+        self.assertEqual(position.realized, 15000 - 5000)
+
+
+class AssignLotsTest(unittest.TestCase):
+    """Imports of portfolio files with --lots fifo"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.session = Session(None)
+        self.book = self.session.book
+        self.eur = self.book.get_table().lookup("CURRENCY", "EUR")
+        root = self.book.get_root_account()
+        assets = self.account(root, "Assets")
+        self.checking = self.account(self.account(assets, "Current Assets"), "Checking Account")
+        self.giro = self.account(self.checking, "Giro", "Konto 12345")
+        self.invest = self.account(assets, "Investments")
+        self.account(self.account(self.account(root, "Expenses"), "Services"), "Broker")
+        self.account(self.account(self.account(root, "Trading"), "CURRENCY"), "EUR")
+        self.descriptions = self.write("descriptions.tsv", "DE0001\tAktien\tFirst AG\n")
+        self.stream = io.StringIO()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def account(self, parent, name, description=""):
+        account = Account(self.book)
+        account.SetName(name)
+        account.SetDescription(description)
+        account.SetCommodity(self.eur)
+        parent.append_child(account)
+        return account
+
+    def write(self, name, content):
+        path = os.path.join(self.dir.name, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def transaction(self, date, num, cents):
+        tx = Transaction(self.book)
+        tx.BeginEdit()
+        tx.SetCurrency(self.eur)
+        tx.SetDate(date.day, date.month, date.year)
+        tx.SetDescription("Wertpapier DE0001")
+        tx.SetNum(num)
+        split = Split(self.book)
+        split.SetParent(tx)
+        split.SetAccount(self.giro)
+        split.SetValue(GncNumeric(cents, 100))
+        split.SetAmount(GncNumeric(cents, 100))
+        tx.CommitEdit()
+
+    def cash_script(self):
+        args = {"--heuristic": False, "--stock-description": self.descriptions, "--lots": "fifo"}
+        return main.CashScript(self.session, args, log.Log(stream=self.stream))
+
+    def import_rows(self, cs, rows):
+        lines = ["12345\t" + date + "\t" + date + "\tDE0001\tFirst AG\t" + nominal + "\tSt\t" + info + "\tx\t" + price
+                 + "\tD1\n" for date, nominal, info, price in rows]
+        cs.read_portfolio_transactions(self.write("portfolio.tsv", "".join(lines)), self.checking, self.invest)
+        cs.log.flush()
+        return cs.find_account_by_isin(self.invest, "DE0001")
+
+    def test_newest_first(self):
+        self.transaction(datetime(2020, 1, 1), "1", -10000)
+        self.transaction(datetime(2020, 2, 1), "2", 30000)
+        cs = self.cash_script()
+        account = self.import_rows(cs, [("2020-02-01", "-10", "Verkauf", "30"), ("2020-01-01", "10", "Kauf", "10")])
+        position = cs.positions.get("DE0001")
+        self.assertEqual(position.shares, 0)
+        self.assertEqual(position.realized, 20000)
+        self.assertEqual(position.unassigned, 0)
+        lot_list = account.GetLotList()
+        self.assertEqual(len(lot_list), 1)
+        self.assertEqual(len(lot_list[0].get_split_list()), 2)
+        self.assertEqual(dict(cs.log.counts), {})
+
+    def test_newest_first_across_batches(self):
+        self.transaction(datetime(2020, 1, 1), "1", -10000)
+        self.transaction(datetime(2020, 2, 1), "2", 30000)
+        cs = self.cash_script()
+        cs.batch_size = 1
+        self.import_rows(cs, [("2020-02-01", "-10", "Verkauf", "30"), ("2020-01-01", "10", "Kauf", "10")])
+        position = cs.positions.get("DE0001")
+        self.assertEqual(position.realized, 20000)
+        self.assertEqual(dict(cs.log.counts), {})
+
+    def test_earlier_split_rebuilds_the_position(self):
+        self.transaction(datetime(2020, 1, 1), "1", -10000)
+        self.transaction(datetime(2020, 2, 1), "2", 30000)
+        cs = self.cash_script()
+        self.import_rows(cs, [("2020-02-01", "-10", "Verkauf", "30")])
+        self.assertEqual(cs.log.counts[("warning", "oversold")], 1)
+        self.import_rows(cs, [("2020-01-01", "10", "Kauf", "10")])
+        position = cs.positions.get("DE0001")
+        self.assertEqual(position.shares, 0)
+        self.assertEqual(position.realized, 20000)
+
+    def test_oversold(self):
+        self.transaction(datetime(2020, 2, 1), "1", 30000)
+        cs = self.cash_script()
+        self.import_rows(cs, [("2020-02-01", "-10", "Verkauf", "30")])
+        self.assertEqual(cs.log.counts[("warning", "oversold")], 1)
+        self.assertIn("exceeds the 0.0 shares held", self.stream.getvalue())
+        self.assertEqual(cs.positions.get("DE0001").unassigned, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
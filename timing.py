@@ -0,0 +1,117 @@
+"""Per-phase timing and counters of an import, enabled with --profile."""
+
+import contextlib
+import csv
+import functools
+import inspect
+import json
+import time
+from collections import defaultdict
+
+
+class Profiler:
+
+    def __init__(self, enabled=False):
+        self.enabled = bool(enabled)
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        # the same numbers for the line that is currently imported
+        self.line_seconds = defaultdict(float)
+        self.line_start = None
+
+    def phase(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timed_phase(name)
+
+    @contextlib.contextmanager
+    def timed_phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+            self.line_seconds[name] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def timed_iter(self, name, iterable):
+        """Yields the items of iterable, the time spent producing them is recorded as phase name"""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.timed_phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def start_line(self):
+        if self.enabled:
+            self.line_seconds.clear()
+            self.line_start = time.perf_counter()
+
+    def line_context(self):
+        """Returns the timings of the current line for error messages, or an empty string"""
+        if not self.enabled or self.line_start == None:
+            return ""
+        phases = ", ".join(name + " " + "{:.4f}".format(seconds) + "s"
+                           for name, seconds in sorted(self.line_seconds.items()))
+        return (" (failed after " + "{:.4f}".format(time.perf_counter() - self.line_start) + "s"
+                + (": " + phases if phases else "") + ")")
+
+    def instrument(self, classes):
+        """Counts the calls of the methods of classes as binding calls"""
+        for cls in classes:
+            if cls == None:
+                continue
+            for name, attr in list(vars(cls).items()):
+                if name.startswith("_") or not inspect.isfunction(attr):
+                    continue
+                setattr(cls, name, self.counting(attr))
+
+    def counting(self, function):
+        counters = self.counters
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            counters["binding calls"] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    def rows(self):
+        """Returns (name, calls, seconds) for every phase, followed by (counter, count, None)"""
+        rows = [(name, self.calls[name], self.seconds[name]) for name in sorted(self.seconds)]
+        rows += [(name, count, None) for name, count in sorted(self.counters.items())]
+        return rows
+
+    def print_summary(self, log):
+        if not self.enabled:
+            return
+        log.info("header", "{:<24}{:>12}{:>12}{:>14}".format("phase", "calls", "seconds", "us/call"))
+        for name, calls, seconds in self.rows():
+            if seconds == None:
+                log.info("counter", "{:<24}{:>12}".format(name, calls), name=name, count=calls)
+            else:
+                log.info("phase", "{:<24}{:>12}{:>12.3f}{:>14.1f}".format(name, calls, seconds, seconds / max(calls, 1) * 1e6),
+                         name=name, calls=calls, seconds=seconds)
+
+    def write(self, path):
+        """Writes the summary as CSV if path ends with .csv, as JSON otherwise"""
+        rows = self.rows()
+        with open(path, "w", newline="") as f:
+            if path.endswith(".csv"):
+                writer = csv.writer(f)
+                writer.writerow(["name", "calls", "seconds"])
+                writer.writerows(rows)
+            else:
+                json.dump([{"name": name, "calls": calls, "seconds": seconds} for name, calls, seconds in rows],
+                          f, indent=2)